@@ -0,0 +1,91 @@
+"""cache.py"""
+
+import multiprocessing as mp
+
+import torch
+
+
+HAND, HITS, MISSES, EVICTIONS = range(4)
+
+
+class SharedImageCache(object):
+    """Decoded uint8 images in a shared-memory arena with CLOCK eviction.
+
+    The arena and its bookkeeping live in shared tensors created in the main
+    process. DataLoader workers inherit them (and later epochs reuse them),
+    so an image decoded by one worker is served to all the others.
+    Capacity is `capacity_bytes // item_bytes` slots of `item_shape`.
+    """
+
+    def __init__(self, num_items, item_shape, capacity_bytes):
+        item_bytes = int(torch.Size(item_shape).numel())
+        self.num_slots = min(num_items, capacity_bytes // item_bytes)
+        self.item_shape = tuple(item_shape)
+        self.arena = torch.empty((self.num_slots,) + self.item_shape, dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((num_items,), -1, dtype=torch.int64).share_memory_()
+        self.owner = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.referenced = torch.zeros(self.num_slots, dtype=torch.uint8).share_memory_()
+        self.meta = torch.zeros(4, dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+        self._views()
+
+    def _views(self):
+        # numpy views of the shared tensors keep the per-item bookkeeping cheap
+        self._slot_of = self.slot_of.numpy()
+        self._owner = self.owner.numpy()
+        self._referenced = self.referenced.numpy()
+        self._meta = self.meta.numpy()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_slot_of', '_owner', '_referenced', '_meta']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    def get(self, index):
+        """Cached image of `index`, or None on a miss."""
+        with self.lock:
+            slot = self._slot_of[index]
+            if slot < 0:
+                self._meta[MISSES] += 1
+                return None
+            self._referenced[slot] = 1
+            self._meta[HITS] += 1
+            return self.arena[slot].clone()
+
+    def put(self, index, img):
+        if self.num_slots == 0 or tuple(img.shape) != self.item_shape:
+            return
+        with self.lock:
+            if self._slot_of[index] >= 0:
+                return
+            slot = self._evict()
+            self.arena[slot].copy_(img)
+            self._owner[slot] = index
+            self._slot_of[index] = slot
+            self._referenced[slot] = 1
+
+    def _evict(self):
+        """Advance the clock hand to a free or unreferenced slot."""
+        while True:
+            slot = self._meta[HAND]
+            self._meta[HAND] = (slot + 1) % self.num_slots
+            if self._owner[slot] < 0:
+                return slot
+            if not self._referenced[slot]:
+                self._slot_of[self._owner[slot]] = -1
+                self._meta[EVICTIONS] += 1
+                return slot
+            self._referenced[slot] = 0
+
+    def stats(self):
+        hits, misses, evictions = (int(v) for v in self._meta[[HITS, MISSES, EVICTIONS]])
+        return {'hits':hits, 'misses':misses, 'evictions':evictions,
+                'hit_rate':hits / max(1, hits + misses),
+                'slots':self.num_slots,
+                'used':int((self._owner >= 0).sum()),
+                'bytes':self.arena.numel()}
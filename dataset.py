@@ -1,25 +1,51 @@
 """dataset.py"""
 
 import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import torch
-from torch.utils.data import Dataset, DataLoader
-from torchvision.datasets import ImageFolder
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data import BatchSampler, Sampler, SequentialSampler
+from torchvision.datasets import ImageFolder, VisionDataset
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
 from torchvision import transforms
 from torchvision import datasets as datasets
 from PIL import Image
 
+from file_index import load_file_index
+from cache import SharedImageCache
+from utils import read_proc_status
+
 
 def is_power_of_2(num):
     return ((num & (num - 1)) == 0) and num != 0
 
 
 class CustomImageFolder(ImageFolder):
-    def __init__(self, root, transform=None):
-        super(CustomImageFolder, self).__init__(root, transform)
+    def __init__(self, root, transform=None, file_index=True, cache_bytes=0):
+        if not file_index:
+            super(CustomImageFolder, self).__init__(root, transform)
+        else:
+            # same attributes as ImageFolder, but the directory scan is
+            # replaced by the cached file index
+            VisionDataset.__init__(self, root, transform=transform)
+            self.loader = default_loader
+            self.extensions = IMG_EXTENSIONS
+            index = load_file_index(self.root, IMG_EXTENSIONS)
+            self.classes = index.classes
+            self.class_to_idx = {c:i for i, c in enumerate(index.classes)}
+            self.samples = self.imgs = index
+            self.targets = index.targets
 
-    def __getitem__(self, index):
+        self.cache = None
+        if cache_bytes:
+            # decoded images share one shape, taken from the first one
+            self.cache = SharedImageCache(len(self), self.load(0).shape, cache_bytes)
+
+    def load(self, index):
         path = self.imgs[index][0]
         img = self.loader(path)
         if self.transform is not None:
@@ -27,6 +53,15 @@ class CustomImageFolder(ImageFolder):
 
         return img
 
+    def __getitem__(self, index):
+        if self.cache is None:
+            return self.load(index)
+        img = self.cache.get(index)
+        if img is None:
+            img = self.load(index)
+            self.cache.put(index, img)
+        return img
+
 
 class CustomTensorDataset(Dataset):
     def __init__(self, data_tensor):
@@ -53,96 +88,340 @@ class CIFAR10Unsupervised(datasets.CIFAR10):
     def __len__(self):
         return len(self.data)
 
-def return_data(args):
+def unpack_bits(x):
+    """Inverse of np.packbits(..., axis=-1) for a uint8 tensor, as float 0/1."""
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=x.device)
+    return ((x.unsqueeze(-1) >> shifts) & 1).flatten(-2).float()
+
+
+class BatchPreprocessor(object):
+    """Move a uint8 batch from the loader to the device and convert it there.
+
+    Image datasets are scaled to [0, 1] floats; dSprites batches are
+    bit-packed and unpacked to 0/1 floats. With `size`, batches stored at
+    another resolution are resized to `size` x `size` on the device
+    (antialiased when downsampling), so one stored copy of a dataset serves
+    every model size.
+    """
+
+    def __init__(self, device, bit_packed=False, size=None):
+        self.device = device
+        self.bit_packed = bit_packed
+        self.size = size
+
+    def __call__(self, x):
+        x = x.to(self.device, non_blocking=True)
+        if self.bit_packed:
+            x = unpack_bits(x)
+        else:
+            x = x.float().div_(255)
+        if self.size is not None and x.shape[-2:] != (self.size, self.size):
+            x = F.interpolate(x, size=(self.size, self.size), mode='bilinear',
+                              align_corners=False, antialias=True).clamp_(0, 1)
+        return x
+
+
+def benchmark_loader(loader, num_batches=100, warmup=5):
+    """Images per second and resident memory (MB) of `loader` and its workers.
+
+    Only child processes started during the measurement are counted, so
+    workers of other loaders that are already running are left out.
+    """
+    import multiprocessing as mp
+    import time
+
+    def batches():
+        # restart the loader at the end of an epoch
+        while True:
+            yield from loader
+
+    existing = {p.pid for p in mp.active_children()}
+    n = 0
+    iterator = batches()
+    for _ in range(warmup):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        n += len(next(iterator))
+    elapsed = time.perf_counter() - start
+    memory = read_proc_status('VmRSS') + sum(read_proc_status('VmRSS', p.pid) for p in mp.active_children()
+                                             if p.pid not in existing)
+    return {'images_per_sec':n / elapsed, 'rss_mb':memory}
+
+
+def load_dsprites(dset_dir):
+    """Open the dSprites npz. Arrays (imgs, latents_classes, ...) load lazily."""
+    root = os.path.join(dset_dir, 'dsprites-dataset/dsprites_ndarray_co1sh3sc6or40x32y32_64x64.npz')
+    if not os.path.exists(root):
+        import subprocess
+        print('Now download dsprites-dataset')
+        subprocess.call(['./download_dsprites.sh'])
+        print('Finished')
+    return np.load(root, encoding='bytes')
+
+
+def default_image_size(name):
+    """Model resolution used for `name` when --image_size is not given."""
+    if name.lower() == 'cifar10':
+        return 32
+    elif name.lower() in ['church128', 'celebahq128', 'bedroom128', 'dog128']:
+        return 128
+    return 64
+
+
+def get_dataset(args):
+    """Datasets yield uint8 images at their stored resolution; resizing to
+    --image_size happens on the device (see BatchPreprocessor). Stored
+    images are only ever downsampled."""
     name = args.dataset
     dset_dir = args.dset_dir
-    batch_size = args.batch_size
-    num_workers = args.num_workers
-    image_size = args.image_size
-    assert image_size == 64, 'currently only image size of 64 is supported'
+    image_size = args.image_size or default_image_size(name)
 
     if name.lower() == '3dchairs':
         root = os.path.join(dset_dir, '3DChairs')
+        # the renders are stored at full size, so they still need a resize
+        # to batch them
         transform = transforms.Compose([
             transforms.Resize((image_size, image_size)),
-            transforms.ToTensor(),])
-        train_kwargs = {'root':root, 'transform':transform}
+            transforms.PILToTensor(),])
+        train_kwargs = {'root':root, 'transform':transform, 'file_index':args.file_index,
+                        'cache_bytes':args.cache_mb * 2**20}
         dset = CustomImageFolder
+        stored_size = image_size
 
     elif name.lower() == 'celeba':
-        root = os.path.join(dset_dir, 'CelebAHQ64PNGLANCZOS')
+        # the smallest stored copy that needs no upsampling; the 128 copy
+        # serves 64px models as well
+        for stored_size in [64, 128]:
+            root = os.path.join(dset_dir, 'CelebAHQ{}PNGLANCZOS'.format(stored_size))
+            if stored_size >= image_size and os.path.isdir(root):
+                break
         transform = transforms.Compose([
-            transforms.Resize((image_size, image_size)),
-            transforms.ToTensor(),])
-        train_kwargs = {'root':root, 'transform':transform}
+            transforms.PILToTensor(),])
+        train_kwargs = {'root':root, 'transform':transform, 'file_index':args.file_index,
+                        'cache_bytes':args.cache_mb * 2**20}
         dset = CustomImageFolder
 
     elif name.lower() == 'dsprites':
-        root = os.path.join(dset_dir, 'dsprites-dataset/dsprites_ndarray_co1sh3sc6or40x32y32_64x64.npz')
-        if not os.path.exists(root):
-            import subprocess
-            print('Now download dsprites-dataset')
-            subprocess.call(['./download_dsprites.sh'])
-            print('Finished')
-        data = np.load(root, encoding='bytes')
-        data = torch.from_numpy(data['imgs']).unsqueeze(1).float()
+        data = load_dsprites(dset_dir)
+        # 0/1 pixels are bit-packed along the width, (N, 1, 64, 8) uint8
+        data = torch.from_numpy(np.packbits(data['imgs'], axis=-1)).unsqueeze(1)
         train_kwargs = {'data_tensor':data}
         dset = CustomTensorDataset
+        stored_size = 64
 
     elif name.lower() == 'cifar10':
         transform = transforms.Compose([
-            transforms.ToTensor(),])
+            transforms.PILToTensor(),])
         root = os.path.join(dset_dir, 'cifar10_data')
         train_kwargs = {'root': root, 'transform': transform, 'download': True}
         dset = CIFAR10Unsupervised
+        stored_size = 32
 
     elif name.lower() == 'church128':
         root = os.path.join(dset_dir, 'church_outdoor_train_png_128')
         transform = transforms.Compose([
-            # transforms.Resize((image_size, image_size)),
-            transforms.ToTensor(),])
-        train_kwargs = {'root':root, 'transform':transform}
+            transforms.PILToTensor(),])
+        train_kwargs = {'root':root, 'transform':transform, 'file_index':args.file_index,
+                        'cache_bytes':args.cache_mb * 2**20}
         dset = CustomImageFolder
+        stored_size = 128
 
     elif name.lower() == 'bedroom128':
         root = os.path.join(dset_dir, 'bedroom128')
         transform = transforms.Compose([
-            # transforms.Resize((image_size, image_size)),
-            transforms.ToTensor(),])
-        train_kwargs = {'root':root, 'transform':transform}
+            transforms.PILToTensor(),])
+        train_kwargs = {'root':root, 'transform':transform, 'file_index':args.file_index,
+                        'cache_bytes':args.cache_mb * 2**20}
         dset = CustomImageFolder
+        stored_size = 128
 
     elif name.lower() == 'dog128':
         root = os.path.join(dset_dir, 'Wss-train128')
         transform = transforms.Compose([
-            # transforms.Resize((image_size, image_size)),
-            transforms.ToTensor(),])
-        train_kwargs = {'root':root, 'transform':transform}
+            transforms.PILToTensor(),])
+        train_kwargs = {'root':root, 'transform':transform, 'file_index':args.file_index,
+                        'cache_bytes':args.cache_mb * 2**20}
         dset = CustomImageFolder
+        stored_size = 128
 
     elif name.lower() == 'celebahq128':
         root = os.path.join(dset_dir, 'CelebAHQ128PNGLANCZOS')
         transform = transforms.Compose([
-            # transforms.Resize((image_size, image_size)),
-            transforms.ToTensor(),])
-        train_kwargs = {'root':root, 'transform':transform}
+            transforms.PILToTensor(),])
+        train_kwargs = {'root':root, 'transform':transform, 'file_index':args.file_index,
+                        'cache_bytes':args.cache_mb * 2**20}
         dset = CustomImageFolder
+        stored_size = 128
     else:
         raise NotImplementedError
 
+    if stored_size < image_size:
+        raise ValueError('{} is stored at {}px, refusing to upsample it to --image_size {}'.format(
+            name, stored_size, image_size))
+    return dset(**train_kwargs)
+
+
+def split_indices(n, val_split, seed=0):
+    """Deterministically split range(n) into train and validation indices."""
+    perm = np.random.RandomState(seed).permutation(n)
+    n_val = int(round(n * val_split))
+    return np.sort(perm[n_val:]), np.sort(perm[:n_val])
+
 
-    train_data = dset(**train_kwargs)
+def get_split(dset, args, split):
+    if not args.val_split:
+        return dset
+    train_idx, val_idx = split_indices(len(dset), args.val_split, args.split_seed)
+    return Subset(dset, train_idx if split == 'train' else val_idx)
+
+
+class ResumableRandomSampler(Sampler):
+    """Random order that is a function of (seed, epoch) and can start mid-epoch.
+
+    Epoch `e` is the permutation drawn from a generator seeded with
+    `seed + e`, so it is reproduced exactly after a restart without
+    touching the global RNGs. `set_epoch(epoch, start)` skips the first
+    `start` indices of that epoch. The epoch advances (and `start` resets)
+    once an iteration has been exhausted; partially consumed iterations
+    leave the position unchanged.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)
+        yield from order[self.start:].tolist()
+        self.set_epoch(self.epoch + 1)
+
+
+class ThreadedBatchLoader(object):
+    """Decode whole batches with a thread pool inside the calling process.
+
+    An alternative to DataLoader worker processes. PIL releases the GIL
+    while decoding, so `num_threads` threads can decode a batch in parallel
+    without copying the dataset object into every worker. Samples (uint8
+    tensors of one shape) are written straight into a ring of
+    `num_buffers` preallocated, pinned batch buffers. The next batch is
+    decoded while the current one is in use. A yielded batch is only valid
+    until `num_buffers - 1` further batches have been requested.
+    """
+
+    def __init__(self, dataset, batch_size, num_threads, sampler=None, drop_last=True,
+                 pin_memory=True, num_buffers=3):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler if sampler is not None else SequentialSampler(dataset)
+        self.batch_sampler = BatchSampler(self.sampler, batch_size, drop_last)
+        self.pool = ThreadPoolExecutor(max(1, num_threads))
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.num_buffers = max(2, num_buffers)
+        self.buffers = None
+        self.next_buffer = 0
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _allocate(self, sample):
+        shape = (self.num_buffers, self.batch_size) + tuple(sample.shape)
+        self.buffers = torch.empty(shape, dtype=sample.dtype)
+        if self.pin_memory:
+            self.buffers = self.buffers.pin_memory()
+
+    def _fill(self, buffer, i, index):
+        buffer[i].copy_(self.dataset[index])
+
+    def _submit(self, indices):
+        if self.buffers is None:
+            self._allocate(self.dataset[indices[0]])
+        buffer = self.buffers[self.next_buffer][:len(indices)]
+        self.next_buffer = (self.next_buffer + 1) % self.num_buffers
+        futures = [self.pool.submit(self._fill, buffer, i, index) for i, index in enumerate(indices)]
+        return buffer, futures
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        pending = None
+        for indices in batches:
+            current, pending = pending, self._submit(indices)
+            if current is not None:
+                yield self._wait(current)
+        if pending is not None:
+            yield self._wait(pending)
+
+    @staticmethod
+    def _wait(job):
+        buffer, futures = job
+        for future in futures:
+            future.result()
+        return buffer
+
+
+def _exit_on_sigterm(worker_id):
+    # a worker killed by the signal makes the main process raise from its
+    # SIGCHLD handler before it can save the preemption checkpoint (see
+    # Solver.train); a clean exit does not
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+
+
+def return_data(args, dset=None):
+    if dset is None:
+        dset = get_dataset(args)
+    train_data = get_split(dset, args, 'train')
+    # the shuffling order depends only on (seed, epoch), see Solver.save_checkpoint
+    sampler = ResumableRandomSampler(train_data, seed=args.seed)
+    if args.loader == 'threads':
+        return ThreadedBatchLoader(train_data,
+                                   batch_size=args.batch_size,
+                                   num_threads=args.num_workers,
+                                   sampler=sampler,
+                                   drop_last=True,
+                                   num_buffers=args.prefetch_depth + 3)
+
+    # a private generator keeps the worker seeding off the global torch RNG
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
     train_loader = DataLoader(train_data,
-                              batch_size=batch_size,
-                              shuffle=True,
-                              num_workers=num_workers,
+                              batch_size=args.batch_size,
+                              sampler=sampler,
+                              num_workers=args.num_workers,
                               pin_memory=True,
-                              drop_last=True)
+                              drop_last=True,
+                              generator=generator,
+                              worker_init_fn=_exit_on_sigterm,
+                              persistent_workers=args.num_workers > 0)
 
     data_loader = train_loader
 
     return data_loader
 
+
+def return_eval_data(args, dset=None):
+    """Loader over the held-out split (the whole dataset if there is none)."""
+    if dset is None:
+        dset = get_dataset(args)
+    val_data = get_split(dset, args, 'val')
+    return DataLoader(val_data,
+                      batch_size=args.eval_batch_size,
+                      shuffle=False,
+                      num_workers=args.eval_num_workers,
+                      pin_memory=True,
+                      drop_last=False,
+                      worker_init_fn=_exit_on_sigterm)
+
 if __name__ == '__main__':
     transform = transforms.Compose([
         transforms.Resize((64, 64)),
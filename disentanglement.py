@@ -0,0 +1,201 @@
+"""disentanglement.py"""
+
+import numpy as np
+
+import torch
+
+
+class FactorTable(object):
+    """Lookup table from dSprites factor classes to dataset indices.
+
+    `table[c_0, ..., c_5]` holds the index of the image with those factor
+    classes, so batches with some factors held fixed are drawn with array
+    indexing instead of searching `latents_classes`.
+    """
+
+    def __init__(self, latents_classes):
+        latents_classes = np.asarray(latents_classes, dtype=np.int64)
+        self.sizes = latents_classes.max(0) + 1
+        self.table = np.full(self.sizes, -1, dtype=np.int64)
+        self.table[tuple(latents_classes.T)] = np.arange(len(latents_classes))
+        assert (self.table >= 0).all(), 'latents_classes does not cover the full factor grid'
+        # factors with a single value (color) carry no information
+        self.factors = np.flatnonzero(self.sizes > 1)
+
+    def sample(self, n, random_state):
+        return (random_state.rand(n, len(self.sizes)) * self.sizes).astype(np.int64)
+
+    def indices(self, classes):
+        return self.table[tuple(classes.T)]
+
+
+class DisentanglementMetrics(object):
+    """Higgins et al. beta-VAE metric, FactorVAE score and MIG for dSprites.
+
+    `images` is the dataset tensor in factor-table order and `preprocess`
+    turns a slice of it into float images on the device. The whole dataset
+    is encoded once, in batches of `batch_size`, and every metric indexes
+    the cached posterior means instead of re-encoding its samples.
+    """
+
+    def __init__(self, net, images, latents_classes, preprocess, batch_size=2048, seed=0):
+        self.net = net
+        self.images = images
+        self.preprocess = preprocess
+        self.table = FactorTable(latents_classes)
+        self.latents_classes = np.asarray(latents_classes, dtype=np.int64)
+        self.batch_size = batch_size
+        self.random_state = np.random.RandomState(seed)
+        self.codes = None
+
+    @torch.no_grad()
+    def encode_dataset(self):
+        """Posterior means of every image, in dataset (factor-table) order."""
+        z_dim = self.net.z_dim
+        codes = torch.empty(len(self.images), z_dim)
+        for i in range(0, len(self.images), self.batch_size):
+            x = self.preprocess(self.images[i:i+self.batch_size])
+            codes[i:i+len(x)] = self.net._encode(x)[:, :z_dim].float().cpu()
+        return codes.numpy()
+
+    def encode(self, indices):
+        if self.codes is None:
+            self.codes = self.encode_dataset()
+        return self.codes[np.asarray(indices, dtype=np.int64)]
+
+    def sample_fixed_factor(self, num_groups, group_size, pairs=False):
+        """Classes of `num_groups` groups of images sharing one random factor.
+
+        With `pairs`, image j of the first half of a group is paired with
+        image j of the second half. The factor is then only shared within
+        each pair and its value is drawn independently for every pair.
+        """
+        factors = self.random_state.choice(self.table.factors, num_groups)
+        classes = self.table.sample(num_groups*group_size, self.random_state).reshape(num_groups, group_size, -1)
+        groups = np.arange(num_groups)
+        if pairs:
+            half = group_size // 2
+            classes[groups, half:, factors] = classes[groups, :half, factors]
+        else:
+            classes[groups, :, factors] = classes[groups, :1, factors]
+        return factors, classes
+
+    def beta_vae_score(self, num_train=10000, num_eval=5000, batch_pairs=64, steps=500):
+        """Accuracy of a linear classifier predicting the fixed factor from
+        the mean absolute latent difference over `batch_pairs` pairs."""
+        num_points = num_train + num_eval
+        factors, classes = self.sample_fixed_factor(num_points, 2*batch_pairs, pairs=True)
+        codes = self.encode(self.table.indices(classes.reshape(-1, classes.shape[-1])))
+        codes = codes.reshape(num_points, 2, batch_pairs, -1)
+        features = np.abs(codes[:, 0] - codes[:, 1]).mean(1)
+        labels = np.searchsorted(self.table.factors, factors)
+
+        train_acc, eval_acc = _linear_classifier_accuracy(
+            features[:num_train], labels[:num_train],
+            features[num_train:], labels[num_train:],
+            len(self.table.factors), steps)
+        return {'beta_vae_train_accuracy':train_acc, 'beta_vae_eval_accuracy':eval_acc}
+
+    def factor_vae_score(self, num_train=10000, num_eval=5000, batch_size=64,
+                         num_variance_estimate=10000, prune_threshold=0.05):
+        """Accuracy of the majority-vote classifier mapping the latent with the
+        least normalized variance within a fixed-factor group to that factor."""
+        random_idx = self.random_state.randint(len(self.latents_classes), size=num_variance_estimate)
+        scale = self.encode(random_idx).std(0)
+        active = scale**2 > prune_threshold
+        if not active.any():
+            return {'factor_vae_train_accuracy':0., 'factor_vae_eval_accuracy':0., 'active_dims':0}
+
+        num_points = num_train + num_eval
+        factors, classes = self.sample_fixed_factor(num_points, batch_size)
+        codes = self.encode(self.table.indices(classes.reshape(-1, classes.shape[-1])))
+        codes = codes.reshape(num_points, batch_size, -1)[:, :, active] / scale[active]
+        argmins = codes.var(1).argmin(1)
+        labels = np.searchsorted(self.table.factors, factors)
+
+        num_factors = len(self.table.factors)
+        votes = np.zeros((int(active.sum()), num_factors), dtype=np.int64)
+        np.add.at(votes, (argmins[:num_train], labels[:num_train]), 1)
+        classifier = votes.argmax(1)
+        train_acc = votes.max(1).sum() / num_train
+        eval_acc = (classifier[argmins[num_train:]] == labels[num_train:]).mean()
+        return {'factor_vae_train_accuracy':float(train_acc),
+                'factor_vae_eval_accuracy':float(eval_acc),
+                'active_dims':int(active.sum())}
+
+    def mig(self, num_samples=10000, num_bins=20):
+        """Mutual information gap between the two latents most informative of
+        each factor, normalized by the factor entropy."""
+        if num_samples is None or num_samples >= len(self.latents_classes):
+            indices = np.arange(len(self.latents_classes))
+        else:
+            indices = self.random_state.choice(len(self.latents_classes), num_samples, replace=False)
+        codes = self.encode(indices)
+        classes = self.latents_classes[indices]
+
+        lo, hi = codes.min(0), codes.max(0)
+        bins = ((codes - lo) / np.maximum(hi - lo, 1e-12) * num_bins).astype(np.int64)
+        bins = np.minimum(bins, num_bins - 1)
+
+        gaps = []
+        for k in self.table.factors:
+            mi = _mutual_information(bins, num_bins, classes[:, k], self.table.sizes[k])
+            counts = np.bincount(classes[:, k], minlength=self.table.sizes[k])
+            entropy = _entropy(counts)
+            top = np.sort(mi)[::-1]
+            gaps.append((top[0] - top[1]) / entropy if len(top) > 1 else top[0] / entropy)
+        return {'mig':float(np.mean(gaps)), 'mig_per_factor':[float(g) for g in gaps]}
+
+    def compute(self):
+        self.net.eval()
+        self.codes = None
+        results = {}
+        results.update(self.beta_vae_score())
+        results.update(self.factor_vae_score())
+        results.update(self.mig())
+        return results
+
+
+def _entropy(counts):
+    p = counts[counts > 0] / counts.sum()
+    return float(-(p * np.log(p)).sum())
+
+
+def _mutual_information(bins, num_bins, factor, factor_size):
+    """MI between every discretized latent and one factor, from a single
+    vectorized joint histogram of shape (z_dim, num_bins, factor_size)."""
+    n, z_dim = bins.shape
+    offsets = np.arange(z_dim) * num_bins * factor_size
+    flat = (offsets + bins * factor_size + factor[:, None]).ravel()
+    joint = np.bincount(flat, minlength=z_dim*num_bins*factor_size)
+    joint = joint.reshape(z_dim, num_bins, factor_size) / n
+    p_z = joint.sum(2, keepdims=True)
+    p_v = joint.sum(1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = joint * np.log(joint / (p_z * p_v))
+    return np.nansum(terms, axis=(1, 2))
+
+
+def _linear_classifier_accuracy(x_train, y_train, x_eval, y_eval, num_classes, steps):
+    """Train a multinomial logistic regression with full-batch L-BFGS."""
+    x_train = torch.from_numpy(x_train).float()
+    x_eval = torch.from_numpy(x_eval).float()
+    y_train = torch.from_numpy(y_train).long()
+    y_eval = torch.from_numpy(y_eval).long()
+    mean, std = x_train.mean(0), x_train.std(0).clamp(min=1e-8)
+    x_train, x_eval = (x_train - mean) / std, (x_eval - mean) / std
+
+    classifier = torch.nn.Linear(x_train.size(1), num_classes)
+    optimizer = torch.optim.LBFGS(classifier.parameters(), max_iter=steps, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = torch.nn.functional.cross_entropy(classifier(x_train), y_train)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    with torch.no_grad():
+        train_acc = (classifier(x_train).argmax(1) == y_train).float().mean().item()
+        eval_acc = (classifier(x_eval).argmax(1) == y_eval).float().mean().item()
+    return train_acc, eval_acc
@@ -0,0 +1,105 @@
+"""distill.py"""
+
+import torch
+import torch.optim as optim
+
+from model import reparametrize
+from utils import time_call
+
+
+class PosteriorLatents(object):
+    """Endless stream of latents drawn from the aggregate posterior.
+
+    Each call encodes the next data batch and samples q(z|x) (or takes the
+    deterministic code for WAE).
+    """
+
+    def __init__(self, encoder, loader, z_dim, preprocess, stochastic=True):
+        self.encoder = encoder
+        self.loader = loader
+        self.z_dim = z_dim
+        self.preprocess = preprocess
+        self.stochastic = stochastic
+        self.iterator = iter(self.loader)
+
+    def next_batch(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.iterator = iter(self.loader)
+            return next(self.iterator)
+
+    @torch.no_grad()
+    def __call__(self, n):
+        latents = []
+        while sum(len(z) for z in latents) < n:
+            x = self.preprocess(self.next_batch())
+            distributions = self.encoder(x)
+            mu = distributions[:, :self.z_dim]
+            if self.stochastic:
+                mu = reparametrize(mu, distributions[:, self.z_dim:])
+            latents.append(mu)
+        return torch.cat(latents)[:n]
+
+
+def distill_decoder(teacher, student, z_dim, device, posterior=None, iters=20000,
+                    batch_size=256, lr=1e-3, posterior_frac=0.5, log_step=1000, log=print):
+    """Train `student` to reproduce the images `teacher` decodes.
+
+    Every batch mixes latents from N(0, I) with latents from the aggregate
+    posterior (a `posterior_frac` share, when `posterior` is given). The loss
+    is the summed squared error of the sigmoid images, averaged over the batch.
+    """
+    teacher.eval()
+    student.train()
+    optimizer = optim.Adam(student.parameters(), lr=lr)
+    num_posterior = int(batch_size * posterior_frac) if posterior is not None else 0
+
+    for it in range(1, iters+1):
+        z = torch.randn(batch_size - num_posterior, z_dim, device=device)
+        if num_posterior:
+            z = torch.cat([z, posterior(num_posterior)])
+        with torch.no_grad():
+            target = torch.sigmoid(teacher(z))
+        loss = (torch.sigmoid(student(z)) - target).pow(2).sum().div(batch_size)
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if it % log_step == 0:
+            log('[distill {}] loss:{:.4f}'.format(it, loss.item()))
+    student.eval()
+    return student
+
+
+def _samples_per_sec(decoder, z):
+    return z.size(0) / time_call(decoder, z)
+
+
+@torch.no_grad()
+def compare_student(teacher, student, z_dim, device, posterior=None, num_samples=1024, batch_size=256):
+    """Image-space agreement with the teacher and sampling throughput of both."""
+    teacher.eval()
+    student.eval()
+    sources = {'prior':torch.randn(num_samples, z_dim, device=device)}
+    if posterior is not None:
+        sources['posterior'] = posterior(num_samples)
+
+    report = {}
+    for name, z in sources.items():
+        mse = 0.
+        for i in range(0, num_samples, batch_size):
+            diff = torch.sigmoid(student(z[i:i+batch_size])) - torch.sigmoid(teacher(z[i:i+batch_size]))
+            mse += diff.pow(2).mean(tuple(range(1, diff.dim()))).sum().item()
+        mse /= num_samples
+        report[name+'_mse'] = mse
+        report[name+'_psnr'] = 10 * torch.log10(torch.tensor(1 / max(mse, 1e-12))).item()
+
+    z = sources['prior'][:batch_size]
+    report['teacher_samples_per_sec'] = _samples_per_sec(teacher, z)
+    report['student_samples_per_sec'] = _samples_per_sec(student, z)
+    report['speedup'] = report['student_samples_per_sec'] / report['teacher_samples_per_sec']
+    report['teacher_parameters'] = sum(p.numel() for p in teacher.parameters())
+    report['student_parameters'] = sum(p.numel() for p in student.parameters())
+    return report
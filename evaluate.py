@@ -0,0 +1,147 @@
+"""evaluate.py"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from losses import reconstruction_loss, kl_divergence, Wasserstein2_dist
+from model import WAE
+
+
+@torch.no_grad()
+def evaluate(net, loader, model, decoder_dist, device, preprocess=None):
+    """Dataset-level reconstruction error, KL, ELBO and W2 over `loader`.
+
+    Per-batch means are turned back into sums and accumulated in float64 on
+    the device, so the results are exact dataset averages regardless of the
+    batch size (including a short last batch). The only host transfer
+    happens at the end. W2 has no per-sample decomposition; it is reported
+    as the root of the sample-weighted mean of squared batch distances.
+    The ELBO includes the decoder's normalizing constant, so it bounds the
+    same log-likelihood that `iwae_log_likelihood` estimates.
+    """
+    z_dim = net.z_dim
+    recon_sum = torch.zeros((), dtype=torch.float64, device=device)
+    kld_sum = torch.zeros(z_dim, dtype=torch.float64, device=device)
+    w2_sum = torch.zeros((), dtype=torch.float64, device=device)
+    n = 0
+
+    for x in loader:
+        x = preprocess(x) if preprocess is not None else x.to(device, non_blocking=True)
+        batch_size = x.size(0)
+        if model in ['H', 'B']:
+            x_recon, mu, logvar = net(x)
+            _, dim_wise_kld, _ = kl_divergence(mu, logvar)
+            kld_sum += dim_wise_kld.double() * batch_size
+        elif model == 'WAE':
+            x_recon, z = net(x)
+            w2_sum += Wasserstein2_dist(z).double().pow(2) * batch_size
+        recon_sum += reconstruction_loss(x, x_recon, decoder_dist).double() * batch_size
+        n += batch_size
+
+    assert n != 0, 'evaluation loader is empty'
+    D = x[0].numel()
+    values = torch.cat([recon_sum.view(1), w2_sum.view(1), kld_sum]).div(n).cpu()
+    results = {'n':n, 'recon_loss':values[0].item()}
+    if model in ['H', 'B']:
+        dim_wise_kld = values[2:]
+        results['total_kld'] = dim_wise_kld.sum().item()
+        results['mean_kld'] = dim_wise_kld.mean().item()
+        results['dim_wise_kld'] = dim_wise_kld.tolist()
+        # on the same likelihood as iwae_log_likelihood, including the
+        # normalizing constant the recon loss leaves out
+        results['elbo'] = log_px_constant(decoder_dist, D) - (results['recon_loss'] + results['total_kld'])
+    else:
+        results['w2_dist'] = values[1].sqrt().item()
+    return results
+
+
+def decoder_bytes_per_sample(decoder, z_dim, device):
+    """Bytes of float32 activations produced by `decoder` for one latent."""
+    sizes = []
+    hooks = [m.register_forward_hook(lambda m, i, o: sizes.append(o.numel()))
+             for m in decoder.modules() if len(list(m.children())) == 0]
+    with torch.no_grad():
+        decoder(torch.zeros(1, z_dim, device=device))
+    for hook in hooks:
+        hook.remove()
+    return 4 * sum(sizes)
+
+
+def log_px_constant(distribution, D):
+    """log p(x|z) + reconstruction_loss, i.e. the normalizing constant of the
+    decoder likelihood over D pixels (zero for bernoulli)."""
+    if distribution == 'gaussian':
+        return -0.5*D*math.log(math.pi)
+    return 0.
+
+
+def log_likelihood_x_given_z(x, x_recon, distribution):
+    """log p(x|z) per sample, matching the scale of `reconstruction_loss`.
+
+    x has shape (B, 1, D) and x_recon (B, K, D). The gaussian decoder is the
+    one the MSE objective implies, N(x; sigmoid(x_recon), 1/2).
+    """
+    if distribution == 'bernoulli':
+        return -F.binary_cross_entropy_with_logits(x_recon, x.expand_as(x_recon), reduction='none').sum(-1)
+    elif distribution == 'gaussian':
+        return -(torch.sigmoid(x_recon) - x).pow(2).sum(-1) + log_px_constant(distribution, x.size(-1))
+    else:
+        raise NotImplementedError
+
+
+@torch.no_grad()
+def iwae_log_likelihood(net, loader, decoder_dist, device, num_samples=1000, memory_budget=2**30,
+                        preprocess=None):
+    """Importance-weighted estimate of the average log p(x) over `loader`.
+
+    For every image, `num_samples` latents are drawn from q(z|x) and decoded as
+    one (B*K) batch. K is split into chunks so that the decoder activations of
+    a chunk stay within `memory_budget` bytes. The log weights are kept in
+    float32 and reduced with log-sum-exp.
+    """
+    if isinstance(net, WAE):
+        raise NotImplementedError('only support model H or B')
+    z_dim = net.z_dim
+    per_sample = decoder_bytes_per_sample(net.decoder, z_dim, device)
+    log_2pi = math.log(2*math.pi)
+    ll_sum = torch.zeros((), dtype=torch.float64, device=device)
+    n = 0
+    chunk = num_samples
+
+    for x in loader:
+        x = preprocess(x) if preprocess is not None else x.to(device, non_blocking=True)
+        B = x.size(0)
+        chunk = int(max(1, min(num_samples, memory_budget // (B * per_sample))))
+        x_flat = x.view(B, 1, -1).float()
+
+        distributions = net._encode(x).float()
+        mu = distributions[:, :z_dim].unsqueeze(1)
+        logvar = distributions[:, z_dim:].unsqueeze(1)
+        std = torch.exp(0.5 * logvar)
+        log_w = torch.empty(B, num_samples, device=device)
+        for k in range(0, num_samples, chunk):
+            K = min(chunk, num_samples - k)
+            eps = torch.randn(B, K, z_dim, device=device)
+            z = mu + std*eps
+            x_recon = net._decode(z.view(B*K, z_dim)).float().view(B, K, -1)
+            log_px = log_likelihood_x_given_z(x_flat, x_recon, decoder_dist)
+            log_pz = -0.5*(z.pow(2) + log_2pi).sum(-1)
+            log_qz = -0.5*(eps.pow(2) + logvar + log_2pi).sum(-1)
+            log_w[:, k:k+K] = log_px + log_pz - log_qz
+
+        ll = torch.logsumexp(log_w, 1) - math.log(num_samples)
+        ll_sum += ll.double().sum()
+        n += B
+
+    assert n != 0, 'evaluation loader is empty'
+    log_likelihood = ll_sum.item() / n
+    D = x[0].numel()
+    # the gaussian is a density over [0, 1] pixels; spreading it over the 256
+    # quantization bins gives the usual discrete bits/dim. bernoulli
+    # (binary dSprites) is already a discrete likelihood
+    discrete = log_likelihood - (D*math.log(256) if decoder_dist == 'gaussian' else 0.)
+    return {'n':n, 'num_samples':num_samples, 'chunk':chunk,
+            'log_likelihood':log_likelihood,
+            'bits_per_dim':-discrete / (D * math.log(2))}
@@ -0,0 +1,175 @@
+"""file_index.py"""
+
+import hashlib
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from torchvision.datasets.folder import has_file_allowed_extension
+
+
+INDEX_VERSION = 1
+
+
+def _scan_dir(path):
+    """File names and subdirectories of one directory. Like os.walk with
+    followlinks=True, symlinks to directories count as directories and
+    unreadable directories are skipped."""
+    fnames, subdirs = [], []
+    try:
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                fnames.append(entry.name)
+    except OSError:
+        pass
+    return fnames, subdirs
+
+
+def _scan_classes(root, classes, extensions, num_threads):
+    """(paths, dirs) of every class directory, in torchvision's make_dataset order.
+
+    Directories at any depth are scanned by a pool of threads: every
+    directory found is queued as a new task, so a single-class root is
+    scanned as much in parallel as a root with many classes. The results
+    are then ordered like sorted(os.walk(...)) within each class.
+    """
+    found = [[] for _ in classes]
+    with ThreadPoolExecutor(max(1, num_threads)) as pool:
+        pending = {}
+        for i, target_class in enumerate(classes):
+            path = os.path.join(root, target_class)
+            pending[pool.submit(_scan_dir, path)] = (i, path)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, path = pending.pop(future)
+                fnames, subdirs = future.result()
+                found[i].append((path, fnames))
+                for subdir in subdirs:
+                    pending[pool.submit(_scan_dir, subdir)] = (i, subdir)
+
+    scans = []
+    for class_dirs in found:
+        paths, dirs = [], []
+        for dirpath, fnames in sorted(class_dirs):
+            dirs.append(os.path.relpath(dirpath, root))
+            for fname in sorted(fnames):
+                if has_file_allowed_extension(fname, extensions):
+                    paths.append(os.path.relpath(os.path.join(dirpath, fname), root))
+        scans.append((paths, dirs))
+    return scans
+
+
+def _mtimes(root, dirs):
+    return np.array([os.stat(os.path.join(root, d)).st_mtime_ns for d in dirs], dtype=np.int64)
+
+
+class FileIndex(object):
+    """File list of an ImageFolder root, stored compactly on disk.
+
+    The relative paths are concatenated into one utf-8 byte array addressed
+    by an offsets array, next to the per-file class targets. The index is
+    valid as long as the root and every directory below it keep the
+    modification times recorded at build time, since adding, removing or
+    renaming a file changes the mtime of its directory. Indexing returns
+    (path, target) like `ImageFolder.samples`.
+    """
+
+    def __init__(self, root, classes, blob, offsets, targets, dirs, mtimes):
+        self.root = root
+        self.classes = classes
+        self.blob = blob
+        self.offsets = offsets
+        self.targets = targets
+        self.dirs = dirs
+        self.mtimes = mtimes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        path = self.blob[self.offsets[index]:self.offsets[index+1]].tobytes().decode('utf-8')
+        return os.path.join(self.root, path), int(self.targets[index])
+
+    @classmethod
+    def build(cls, root, extensions, num_threads=16):
+        root = os.path.abspath(os.path.expanduser(root))
+        classes = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+        if not classes:
+            raise FileNotFoundError("Couldn't find any class folder in {}.".format(root))
+
+        scans = _scan_classes(root, classes, extensions, num_threads)
+
+        empty = [c for c, (paths, _) in zip(classes, scans) if not paths]
+        if empty:
+            raise FileNotFoundError('Found no valid file for the classes {}. Supported extensions are: {}'.format(
+                ', '.join(empty), ', '.join(extensions)))
+
+        encoded = [p.encode('utf-8') for paths, _ in scans for p in paths]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        np.cumsum([len(p) for p in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        targets = np.concatenate([np.full(len(paths), i, dtype=np.int32)
+                                  for i, (paths, _) in enumerate(scans)])
+        dirs = ['.'] + [d for _, class_dirs in scans for d in class_dirs]
+        return cls(root, classes, blob, offsets, targets, dirs, _mtimes(root, dirs))
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=INDEX_VERSION, root=self.root,
+                 classes=np.array(self.classes), blob=self.blob, offsets=self.offsets,
+                 targets=self.targets, dirs=np.array(self.dirs), mtimes=self.mtimes)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != INDEX_VERSION:
+                return None
+            return cls(str(data['root']), data['classes'].tolist(), data['blob'], data['offsets'],
+                       data['targets'], data['dirs'].tolist(), data['mtimes'])
+
+    def is_valid(self, root):
+        if self.root != os.path.abspath(os.path.expanduser(root)):
+            return False
+        try:
+            return np.array_equal(_mtimes(self.root, self.dirs), self.mtimes)
+        except OSError:
+            return False
+
+
+def index_path(root, cache_dir=None):
+    """Index location for `root`, keyed by its absolute path.
+
+    The index is kept outside the dataset: writing it into the root would
+    change the very mtime it is validated against.
+    """
+    root = os.path.abspath(os.path.expanduser(root))
+    key = hashlib.sha1(root.encode('utf-8')).hexdigest()
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'beta-vae')
+    return os.path.join(cache_dir, 'file_index_{}.npz'.format(key))
+
+
+def load_file_index(root, extensions, cache_dir=None, num_threads=16):
+    """Load the cached index of `root`, rebuilding and saving it when stale."""
+    path = index_path(root, cache_dir)
+    if os.path.isfile(path):
+        try:
+            index = FileIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            index = None
+        if index is not None and index.is_valid(root):
+            return index
+
+    index = FileIndex.build(root, extensions, num_threads)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index.save(path)
+    except OSError:
+        pass
+    return index
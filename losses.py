@@ -0,0 +1,57 @@
+"""losses.py"""
+
+import numpy as np
+import ot
+
+import torch
+import torch.nn.functional as F
+
+
+def reconstruction_loss(x, x_recon, distribution):
+    """Summed over pixels and averaged over the batch. `x_recon` may hold
+    K reconstructions per image (B*K rows, see BetaVAE_H.forward); the loss
+    then also averages over the K samples."""
+    batch_size = x_recon.size(0)
+    assert batch_size != 0
+    if batch_size != x.size(0):
+        num_samples = batch_size // x.size(0)
+        x_recon = x_recon.view((x.size(0), num_samples) + x.size()[1:])
+        x = x.unsqueeze(1).expand_as(x_recon)
+
+    if distribution == 'bernoulli':
+        recon_loss = F.binary_cross_entropy_with_logits(x_recon, x, size_average=False).div(batch_size)
+    elif distribution == 'gaussian':
+        x_recon = F.sigmoid(x_recon)
+        recon_loss = F.mse_loss(x_recon, x, size_average=False).div(batch_size)
+    else:
+        recon_loss = None
+
+    return recon_loss
+
+
+def kl_divergence(mu, logvar):
+    batch_size = mu.size(0)
+    assert batch_size != 0
+    if mu.data.ndimension() == 4:
+        mu = mu.view(mu.size(0), mu.size(1))
+    if logvar.data.ndimension() == 4:
+        logvar = logvar.view(logvar.size(0), logvar.size(1))
+
+    klds = -0.5*(1 + logvar - mu.pow(2) - logvar.exp())
+    total_kld = klds.sum(1).mean(0, True)
+    dimension_wise_kld = klds.mean(0)
+    mean_kld = klds.mean(1).mean(0, True)
+
+    return total_kld, dimension_wise_kld, mean_kld
+
+def Wasserstein2_dist(z):
+    N, ndim = z.size()
+    a, b = np.ones((N,)) / N, np.ones((N,)) / N  # points have equal probability of 1/N
+    prior = np.random.randn(N, ndim)
+    M = ot.dist(z.data.cpu().numpy(), prior, metric='sqeuclidean')
+    G = ot.emd(a, b, M, numItermax=500000)
+    ix1, ix2 = np.nonzero(G)
+    prior_var = torch.from_numpy(prior[ix2]).to(z.device, z.dtype)
+    w2 = torch.sqrt(torch.mean(torch.sum(torch.pow(z - prior_var, 2), dim=1)))
+    # w2 = torch.mean(torch.norm(x - z_var, p=2, dim=1))
+    return w2
@@ -13,6 +13,8 @@ torch.backends.cudnn.benchmark = True
 
 
 def main(args):
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
     seed = args.seed
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -22,8 +24,29 @@ def main(args):
 
     if args.train:
         net.train()
+    elif args.mode == 'eval':
+        net.evaluate()
+    elif args.mode == 'iwae':
+        net.log_likelihood(args.iw_samples, args.iw_memory_mb * 2**20)
+    elif args.mode == 'disentangle':
+        net.disentanglement()
+    elif args.mode == 'prune':
+        net.prune(args.kl_threshold)
+    elif args.mode == 'posterior':
+        net.fit_posterior(args)
+    elif args.mode == 'sweep':
+        net.sweep(args.sweep_procs, args.sweep_images)
+    elif args.mode == 'tune':
+        net.tune(args)
+    elif args.mode == 'bench_loader':
+        net.benchmark_loaders(args)
+    elif args.mode == 'distill':
+        net.distill(args.student_width, args.student_depth or None,
+                    args.distill_iters, args.distill_batch_size, args.distill_lr)
     else:
         # net.traverse()
+        if args.quantize != 'none':
+            net.quantize(args.quantize)
         net.rand_samples(args.num_samples)
 
 
@@ -31,6 +54,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='toy Beta-VAE')
 
     parser.add_argument('--train', default=True, type=str2bool, help='train or traverse')
+    parser.add_argument('--mode', default='sample', type=str, help='what to run when --train False. sample/eval/iwae/disentangle/prune/distill/sweep/posterior/tune/bench_loader')
     parser.add_argument('--seed', default=1, type=int, help='random seed')
     parser.add_argument('--cuda', default=True, type=str2bool, help='enable cuda')
     parser.add_argument('--max_iter', default=1e6, type=float, help='maximum training iteration')
@@ -43,14 +67,27 @@ if __name__ == "__main__":
     parser.add_argument('--gamma', default=1000, type=float, help='gamma parameter for KL-term in understanding beta-VAE')
     parser.add_argument('--C_max', default=25, type=float, help='capacity parameter(C) of bottleneck channel')
     parser.add_argument('--C_stop_iter', default=1e5, type=float, help='when to stop increasing the capacity')
+    parser.add_argument('--num_z_samples', default=1, type=int, help='latent samples decoded per encoded image during training (H/B models)')
     parser.add_argument('--lr', default=1e-4, type=float, help='learning rate')
     parser.add_argument('--beta1', default=0.9, type=float, help='Adam optimizer beta1')
     parser.add_argument('--beta2', default=0.999, type=float, help='Adam optimizer beta2')
 
     parser.add_argument('--dset_dir', default='data', type=str, help='dataset directory')
     parser.add_argument('--dataset', default='CelebA', type=str, help='dataset name')
-    parser.add_argument('--image_size', default=64, type=int, help='image size. now only (64,64) is supported')
-    parser.add_argument('--num_workers', default=2, type=int, help='dataloader num_workers')
+    parser.add_argument('--image_size', default=None, type=int, help='model resolution 32/64/128, resized on the device from the stored images. default: 32 for cifar10, 128 for the *128 datasets, 64 otherwise')
+    parser.add_argument('--num_workers', default=2, type=int, help='dataloader num_workers (decoding threads with --loader threads)')
+    parser.add_argument('--loader', default='processes', type=str, help='decode with DataLoader worker processes or a thread pool. processes/threads')
+    parser.add_argument('--num_threads', default=0, type=int, help='torch intra-op threads. 0 keeps the torch default')
+    parser.add_argument('--prefetch_depth', default=2, type=int, help='number of batches staged on the device ahead of the training step')
+    parser.add_argument('--file_index', default=True, type=str2bool, help='cache the file list of ImageFolder datasets between launches')
+    parser.add_argument('--cache_mb', default=0, type=int, help='shared-memory budget in MB for decoded ImageFolder images. 0 disables')
+    parser.add_argument('--val_split', default=0, type=float, help='fraction of the dataset held out for evaluation')
+    parser.add_argument('--split_seed', default=0, type=int, help='seed of the deterministic train/validation split')
+    parser.add_argument('--eval_step', default=0, type=int, help='number of iterations after which the validation split is evaluated. 0 disables')
+    parser.add_argument('--eval_batch_size', default=512, type=int, help='evaluation batch size')
+    parser.add_argument('--eval_num_workers', default=4, type=int, help='evaluation dataloader num_workers')
+    parser.add_argument('--iw_samples', default=1000, type=int, help='number of importance samples per image for the log-likelihood estimate')
+    parser.add_argument('--iw_memory_mb', default=1024, type=int, help='decoder activation budget in MB used to chunk the importance samples')
 
     parser.add_argument('--viz_on', default=True, type=str2bool, help='enable visdom visualization')
     parser.add_argument('--viz_name', default='main', type=str, help='visdom env name')
@@ -61,11 +98,29 @@ if __name__ == "__main__":
     parser.add_argument('--gather_step', default=100, type=int, help='numer of iterations after which data is gathered for visdom')
     parser.add_argument('--display_step', default=5000, type=int, help='number of iterations after which loss data is printed and visdom is updated')
     parser.add_argument('--save_step', default=5000, type=int, help='number of iterations after which a checkpoint is saved')
+    parser.add_argument('--snapshot_step', default=50000, type=int, help='number of iterations after which a weights-only snapshot is kept')
+    parser.add_argument('--snapshot_fp16', default=False, type=str2bool, help='store snapshot weights in half precision')
+    parser.add_argument('--snapshot_compress', default=False, type=str2bool, help='zlib-compress snapshot weights')
 
     parser.add_argument('--ckpt_dir', default='checkpoints', type=str, help='checkpoint directory')
     parser.add_argument('--ckpt_name', default='last', type=str, help='load previous checkpoint. insert checkpoint filename')
 
     parser.add_argument('--num_samples', default=100, type=int, help='number of samples to generate')
+    parser.add_argument('--tune_batch_sizes', default='16,32,64,128,256,512', type=str, help='comma-separated batch sizes tried by --mode tune')
+    parser.add_argument('--tune_memory_mb', default=0, type=int, help='memory limit for --mode tune (device memory on cuda). 0 uses 90%% of what is available')
+    parser.add_argument('--sweep_procs', default=4, type=int, help='processes evaluating checkpoints in parallel with --mode sweep, each pinned to its share of the cores')
+    parser.add_argument('--sweep_images', default=10000, type=int, help='held-out images every checkpoint is evaluated on with --mode sweep')
+    parser.add_argument('--kl_threshold', default=0.01, type=float, help='latent units with a smaller average KL are pruned')
+    parser.add_argument('--student_width', default=0.5, type=float, help='channel multiplier of the distilled decoder')
+    parser.add_argument('--student_depth', default=0, type=int, help='upsampling layers of the distilled decoder. 0 keeps the teacher depth')
+    parser.add_argument('--distill_iters', default=20000, type=int, help='distillation iterations')
+    parser.add_argument('--distill_batch_size', default=256, type=int, help='latents per distillation step')
+    parser.add_argument('--distill_lr', default=1e-3, type=float, help='distillation learning rate')
+    parser.add_argument('--prior', default='normal', type=str, help='latents for sampling and visualization: N(0, I) or the fitted aggregate posterior. normal/gaussian/gmm')
+    parser.add_argument('--posterior_components', default=0, type=int, help='mixture components fitted to the aggregate posterior with --mode posterior. 0 fits a single gaussian')
+    parser.add_argument('--posterior_reservoir', default=10000, type=int, help='latents kept for fitting the mixture')
+    parser.add_argument('--decoder_ckpt', default=None, type=str, help='sample and traverse with this distilled decoder')
+    parser.add_argument('--quantize', default='none', type=str, help='sample with an int8 CPU decoder. none/dynamic/static')
 
     args = parser.parse_args()
 
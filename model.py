@@ -1,5 +1,7 @@
 """model.py"""
 
+import math
+
 import torch
 import torch.nn as nn
 #import torch.nn.functional as F
@@ -13,6 +15,13 @@ def reparametrize(mu, logvar):
     return mu + std*eps
 
 
+def repeat_samples(*tensors, num_samples=1):
+    """Repeat every row `num_samples` times, keeping the repeats adjacent."""
+    if num_samples == 1:
+        return tensors
+    return tuple(t.repeat_interleave(num_samples, dim=0) for t in tensors)
+
+
 class View(nn.Module):
     def __init__(self, size):
         super(View, self).__init__()
@@ -122,6 +131,40 @@ def get_decoder128(nc, z_dim):
         nn.ConvTranspose2d(32, nc, 4, 2, 1),  # B, nc, 64, 64
     )
 
+def get_student_decoder(nc, z_dim, input_size=64, width=0.5, depth=None):
+    """Narrower (and optionally shallower) version of get_decoder{32,64,128}.
+
+    Channels are scaled by `width`. With `depth` below the number of x2
+    upsampling layers the teacher uses, the first layers upsample x4 instead.
+    """
+    num_up = int(math.log2(input_size // 4))
+    depth = num_up if depth is None else depth
+    assert num_up / 2 <= depth <= num_up, 'depth must be between {} and {}'.format(math.ceil(num_up/2), num_up)
+    hidden = max(8, int(256 * width))
+    channels = [max(8, int(c * width)) for c in [64, 64, 32, 32, 32][:depth]]
+
+    layers = [
+        nn.Linear(z_dim, hidden),  # B, hidden
+        View((-1, hidden, 1, 1)),  # B, hidden,  1,  1
+        nn.ReLU(True),
+        nn.ConvTranspose2d(hidden, channels[0], 4),  # B, c0,  4,  4
+        nn.ReLU(True),
+    ]
+    num_x4 = num_up - depth
+    for i in range(depth):
+        out_channels = nc if i == depth - 1 else channels[i + 1]
+        if i < num_x4:
+            layers.append(nn.ConvTranspose2d(channels[i], out_channels, 8, 4, 2))
+        else:
+            layers.append(nn.ConvTranspose2d(channels[i], out_channels, 4, 2, 1))
+        if i < depth - 1:
+            layers.append(nn.ReLU(True))
+    decoder = nn.Sequential(*layers)
+    for m in decoder:
+        kaiming_init(m)
+    return decoder
+
+
 class WAE(nn.Module):
     def __init__(self, z_dim=10, nc=3, input_size=64):
         super().__init__()
@@ -185,11 +228,14 @@ class BetaVAE_H(nn.Module):
             for m in self._modules[block]:
                 kaiming_init(m)
 
-    def forward(self, x):
+    def forward(self, x, num_samples=1):
+        """With num_samples K > 1 the decoder runs on K latents drawn per
+        image, returned as a (B*K, ...) batch with each image's samples
+        adjacent."""
         distributions = self._encode(x)
         mu = distributions[:, :self.z_dim]
         logvar = distributions[:, self.z_dim:]
-        z = reparametrize(mu, logvar)
+        z = reparametrize(*repeat_samples(mu, logvar, num_samples=num_samples))
         x_recon = self._decode(z)
 
         return x_recon, mu, logvar
@@ -249,12 +295,12 @@ class BetaVAE_B(BetaVAE_H):
             for m in self._modules[block]:
                 kaiming_init(m)
 
-    def forward(self, x):
+    def forward(self, x, num_samples=1):
         distributions = self._encode(x)
         mu = distributions[:, :self.z_dim]
         logvar = distributions[:, self.z_dim:]
-        z = reparametrize(mu, logvar)
-        x_recon = self._decode(z).view(x.size())
+        z = reparametrize(*repeat_samples(mu, logvar, num_samples=num_samples))
+        x_recon = self._decode(z).view((-1,) + x.size()[1:])
 
         return x_recon, mu, logvar
 
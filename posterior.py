@@ -0,0 +1,197 @@
+"""posterior.py"""
+
+import math
+
+import torch
+
+from model import reparametrize
+
+
+class GaussianStats(object):
+    """Streaming mean and covariance with Welford/Chan updates.
+
+    Each batch is reduced to its own count, mean and centered scatter
+    matrix, which are merged into the running state with Chan et al.'s
+    pairwise formula. Accumulation is in float64, and two instances (from
+    other workers or processes) merge the same way.
+    """
+
+    def __init__(self, dim, device='cpu'):
+        self.n = 0
+        self.mean = torch.zeros(dim, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+
+    def update(self, x):
+        x = x.detach().double()
+        mean = x.mean(0)
+        centered = x - mean
+        self._merge(x.size(0), mean, centered.t() @ centered)
+
+    def merge(self, other):
+        self._merge(other.n, other.mean.to(self.mean.device), other.m2.to(self.m2.device))
+
+    def _merge(self, n, mean, m2):
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * (n / total)
+        self.m2 += m2 + torch.outer(delta, delta) * (self.n * n / total)
+        self.n = total
+
+    def covariance(self):
+        return self.m2 / max(1, self.n - 1)
+
+
+class Reservoir(object):
+    """Uniform sample of at most `size` rows of a stream.
+
+    Every row gets a random key and the rows with the smallest keys are
+    kept, so two reservoirs merge by keeping the smallest keys of both.
+    """
+
+    def __init__(self, size, generator=None):
+        self.size = size
+        self.generator = generator
+        self.keys = None
+        self.rows = None
+
+    def update(self, x):
+        keys = torch.rand(x.size(0), generator=self.generator).to(x.device)
+        self._merge(keys, x.detach())
+
+    def merge(self, other):
+        if other.rows is not None:
+            self._merge(other.keys, other.rows)
+
+    def _merge(self, keys, rows):
+        if self.rows is not None:
+            keys = torch.cat([self.keys, keys.to(self.keys.device)])
+            rows = torch.cat([self.rows, rows.to(self.rows.device)])
+        if len(keys) > self.size:
+            keys, order = keys.topk(self.size, largest=False)
+            rows = rows[order]
+        self.keys, self.rows = keys, rows
+
+
+def fit_gmm(x, num_components, iters=100, reg=1e-6, seed=0, tol=1e-6):
+    """Full-covariance Gaussian mixture fitted to the rows of `x` with EM."""
+    x = x.double()
+    n, dim = x.shape
+    generator = torch.Generator().manual_seed(seed)
+    means = x[torch.randperm(n, generator=generator)[:num_components].to(x.device)].clone()
+    num_components = len(means)
+    covs = torch.cov(x.t()).expand(num_components, dim, dim).clone()
+    covs += reg * torch.eye(dim, dtype=x.dtype, device=x.device)
+    weights = torch.full((num_components,), 1 / num_components, dtype=x.dtype, device=x.device)
+
+    previous = -math.inf
+    for _ in range(iters):
+        # E step
+        log_prob = _log_normal(x, means, covs) + weights.log()
+        log_norm = torch.logsumexp(log_prob, 1, keepdim=True)
+        resp = (log_prob - log_norm).exp()
+        # M step
+        counts = resp.sum(0) + 1e-10
+        weights = counts / n
+        means = (resp.t() @ x) / counts[:, None]
+        centered = x[None] - means[:, None]
+        covs = torch.einsum('kn,kni,knj->kij', resp.t(), centered, centered) / counts[:, None, None]
+        covs += reg * torch.eye(dim, dtype=x.dtype, device=x.device)
+
+        log_likelihood = log_norm.mean().item()
+        if log_likelihood - previous < tol:
+            break
+        previous = log_likelihood
+    return weights, means, covs
+
+
+def _log_normal(x, means, covs):
+    """log N(x_n; means_k, covs_k) of shape (N, K)."""
+    chol = torch.linalg.cholesky(covs)
+    diff = (x[None] - means[:, None]).transpose(1, 2)
+    solved = torch.linalg.solve_triangular(chol, diff, upper=False)
+    maha = solved.pow(2).sum(1)
+    log_det = 2 * chol.diagonal(dim1=1, dim2=2).log().sum(1)
+    dim = x.size(1)
+    return (-0.5 * (maha + log_det[:, None] + dim * math.log(2 * math.pi))).t()
+
+
+class AggregatePosterior(object):
+    """Gaussian (and optionally mixture) fit to the aggregate posterior q(z).
+
+    `accumulate` takes the encoder output of one batch. q(z) is the average
+    of the per-image posteriors, so its covariance is the covariance of
+    the posterior means plus the mean posterior variance. Deterministic
+    encoders (WAE) pass no `logvar`. With `reservoir_size`, latents sampled
+    from q(z|x) are also kept in a mergeable reservoir. `finalize` then fits
+    a `num_components` Gaussian mixture to them.
+    """
+
+    def __init__(self, z_dim, device='cpu', reservoir_size=0, seed=0):
+        self.z_dim = z_dim
+        self.stats = GaussianStats(z_dim, device)
+        self.var_sum = torch.zeros(z_dim, dtype=torch.float64, device=device)
+        self.reservoir = Reservoir(reservoir_size, torch.Generator().manual_seed(seed)) if reservoir_size else None
+        self.mean = self.cov = None
+        self.gmm = None
+
+    def accumulate(self, mu, logvar=None):
+        self.stats.update(mu)
+        z = mu
+        if logvar is not None:
+            self.var_sum += logvar.detach().double().exp().sum(0)
+            if self.reservoir is not None:
+                z = reparametrize(mu, logvar)
+        if self.reservoir is not None:
+            self.reservoir.update(z.detach().float())
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.var_sum += other.var_sum.to(self.var_sum.device)
+        if self.reservoir is not None and other.reservoir is not None:
+            self.reservoir.merge(other.reservoir)
+
+    def finalize(self, num_components=0):
+        self.mean = self.stats.mean.float().cpu()
+        cov = self.stats.covariance() + torch.diag(self.var_sum / max(1, self.stats.n))
+        self.cov = cov.float().cpu()
+        if num_components and self.reservoir is not None:
+            self.gmm = tuple(t.float().cpu() for t in fit_gmm(self.reservoir.rows, num_components))
+        return self
+
+    def state_dict(self):
+        return {'n':self.stats.n, 'mean':self.mean, 'cov':self.cov, 'gmm':self.gmm}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        posterior = cls(state['mean'].numel())
+        posterior.stats.n = state['n']
+        posterior.mean, posterior.cov, posterior.gmm = state['mean'], state['cov'], state['gmm']
+        return posterior
+
+    def sample(self, num_samples, kind='gaussian', seed=None, device='cpu'):
+        """Draw latents from the fitted Gaussian or mixture ('gmm')."""
+        generator = torch.Generator()
+        if seed is not None:
+            generator.manual_seed(seed)
+        else:
+            generator.seed()
+        eps = torch.randn(num_samples, self.z_dim, generator=generator)
+        if kind == 'gaussian':
+            z = self.mean + eps @ _cholesky(self.cov).t()
+        elif kind == 'gmm':
+            if self.gmm is None:
+                raise ValueError('no mixture was fitted, rerun with --posterior_components > 0')
+            weights, means, covs = self.gmm
+            components = torch.multinomial(weights, num_samples, replacement=True, generator=generator)
+            chol = _cholesky(covs)[components]
+            z = means[components] + (chol @ eps.unsqueeze(-1)).squeeze(-1)
+        else:
+            raise NotImplementedError('only support gaussian or gmm')
+        return z.to(device)
+
+
+def _cholesky(cov):
+    eye = torch.eye(cov.size(-1), dtype=cov.dtype)
+    return torch.linalg.cholesky(cov + 1e-6 * eye)
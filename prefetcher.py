@@ -0,0 +1,112 @@
+"""prefetcher.py"""
+
+import queue
+import threading
+import time
+
+import torch
+
+
+class DevicePrefetcher(object):
+    """Stage upcoming batches on the device from a background thread.
+
+    The thread keeps pulling from `loader` across epochs and runs
+    `preprocess` (host-to-device copy and conversion, see
+    dataset.BatchPreprocessor) on a side CUDA stream, so up to `depth`
+    batches are ready while the current step runs. Iterating the prefetcher
+    yields one epoch. `starved` counts the steps that found no staged batch
+    and had to wait for the loader.
+    """
+
+    def __init__(self, loader, preprocess, depth=2):
+        self.loader = loader
+        self.preprocess = preprocess
+        self.device = torch.device(preprocess.device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.queue = queue.Queue(maxsize=max(1, depth))
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        while self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.1)
+        self.thread = None
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _stage(self, x):
+        if self.stream is None:
+            return self.preprocess(x), None
+        with torch.cuda.stream(self.stream):
+            x = self.preprocess(x)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        # the host batch may be a reused buffer (ThreadedBatchLoader), so let
+        # the copy finish before asking the loader for more
+        event.synchronize()
+        return x, event
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                for x in self.loader:
+                    if not self._put(self._stage(x)):
+                        return
+                # end of epoch
+                if not self._put(None):
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _get(self):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            self.starved += 1
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.wait_time += time.perf_counter() - start
+            return item
+
+    def __iter__(self):
+        self.start()
+        while True:
+            item = self._get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            x, event = item
+            if event is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_event(event)
+                x.record_stream(stream)
+            self.batches += 1
+            yield x
+
+    def stats(self):
+        return {'batches':self.batches,
+                'starved':self.starved,
+                'starved_fraction':self.starved / max(1, self.batches),
+                'wait_time':self.wait_time}
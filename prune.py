@@ -0,0 +1,101 @@
+"""prune.py"""
+
+import torch
+import torch.nn as nn
+
+from model import BetaVAE_B
+from utils import time_call
+
+
+def split_active_dims(dim_wise_kld, threshold=0.01):
+    """Indices of latent units whose average KL is above/below `threshold` nats."""
+    dim_wise_kld = torch.as_tensor(dim_wise_kld)
+    active = torch.nonzero(dim_wise_kld > threshold).view(-1)
+    inactive = torch.nonzero(dim_wise_kld <= threshold).view(-1)
+    return active, inactive
+
+
+def _linear_layers(sequential):
+    return [m for m in sequential.modules() if isinstance(m, nn.Linear)]
+
+
+def build_like(net, z_dim):
+    if isinstance(net, BetaVAE_B):
+        return net.__class__(z_dim, net.nc)
+    return net.__class__(z_dim, net.nc, input_size=net.input_size)
+
+
+@torch.no_grad()
+def prune_latents(net, active, fill=None):
+    """Copy of `net` that only keeps the latent units in `active`.
+
+    The rows of the encoder's last Linear that produce the kept means (and
+    log-variances) and the matching columns of the decoder's first Linear
+    are sliced out. The dropped inputs are folded into the decoder bias at
+    `fill`, the prior mean (zero) by default.
+    """
+    z_dim = net.z_dim
+    active = torch.as_tensor(active, dtype=torch.long).cpu()
+    inactive = torch.tensor([j for j in range(z_dim) if j not in set(active.tolist())], dtype=torch.long)
+    if fill is None:
+        fill = torch.zeros(z_dim)
+
+    pruned = build_like(net, len(active)).to(next(net.parameters()).device)
+    state = {k:v.clone() for k, v in net.state_dict().items()}
+
+    enc = _linear_layers(net.encoder)[-1]
+    dec = _linear_layers(net.decoder)[0]
+    enc_name = [k for k, m in net.named_modules() if m is enc][0]
+    dec_name = [k for k, m in net.named_modules() if m is dec][0]
+
+    rows = active if enc.out_features == z_dim else torch.cat([active, active + z_dim])
+    state[enc_name+'.weight'] = enc.weight[rows.to(enc.weight.device)].clone()
+    state[enc_name+'.bias'] = enc.bias[rows.to(enc.bias.device)].clone()
+
+    weight = dec.weight
+    state[dec_name+'.weight'] = weight[:, active.to(weight.device)].clone()
+    state[dec_name+'.bias'] = dec.bias + weight[:, inactive.to(weight.device)] @ fill[inactive].to(weight)
+
+    pruned.load_state_dict(state)
+    return pruned.eval()
+
+
+def num_parameters(net):
+    return sum(p.numel() for p in net.parameters())
+
+
+def _throughput(fn, x):
+    return x.size(0) / time_call(fn, x)
+
+
+@torch.no_grad()
+def compare_pruned(net, pruned, active, x, fill=None, num_traverse=10):
+    """Output agreement and speed of the reduced model against the full one."""
+    net.eval()
+    z_dim, device = net.z_dim, x.device
+    active = torch.as_tensor(active, dtype=torch.long).to(device)
+    if fill is None:
+        fill = torch.zeros(z_dim, device=device)
+
+    mu_full = net._encode(x)[:, :z_dim][:, active]
+    mu_pruned = pruned._encode(x)[:, :pruned.z_dim]
+
+    z = torch.randn(x.size(0), len(active), device=device)
+    z_full = fill.to(device).expand(x.size(0), z_dim).clone()
+    z_full[:, active] = z
+    samples_full = net._decode(z_full)
+    samples_pruned = pruned._decode(z)
+
+    traverse_full = z_full[:1].repeat(z_dim*num_traverse, 1)
+    traverse_pruned = z[:1].repeat(len(active)*num_traverse, 1)
+    return {'z_dim':z_dim, 'active_dims':len(active),
+            'encode_max_abs_diff':(mu_full - mu_pruned).abs().max().item(),
+            'decode_max_abs_diff':(samples_full - samples_pruned).abs().max().item(),
+            'full_parameters':num_parameters(net),
+            'pruned_parameters':num_parameters(pruned),
+            'full_encode_per_sec':_throughput(net._encode, x),
+            'pruned_encode_per_sec':_throughput(pruned._encode, x),
+            'full_sample_per_sec':_throughput(net._decode, z_full),
+            'pruned_sample_per_sec':_throughput(pruned._decode, z),
+            'full_traverse_per_sec':_throughput(net._decode, traverse_full) / (z_dim*num_traverse),
+            'pruned_traverse_per_sec':_throughput(pruned._decode, traverse_pruned) / (len(active)*num_traverse)}
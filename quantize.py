@@ -0,0 +1,213 @@
+"""quantize.py"""
+
+import copy
+import io
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+
+from model import View
+from utils import time_call
+
+
+def set_quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+    return torch.backends.quantized.engine
+
+
+class QuantizableDecoder(nn.Module):
+    """A decoder stack wrapped with quant/dequant stubs for static quantization."""
+
+    def __init__(self, decoder):
+        super(QuantizableDecoder, self).__init__()
+        self.quant = tq.QuantStub()
+        self.decoder = decoder
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, z):
+        return self.dequant(self.decoder(self.quant(z)))
+
+
+@torch.no_grad()
+def conv_transpose_as_conv(m):
+    """Conv2d (+ PixelShuffle) computing the same output as ConvTranspose2d `m`.
+
+    Stride 1 becomes a convolution with the flipped kernel. The upsampling
+    layers (kernel 2s, stride s, padding s/2) become a 3x3 convolution with
+    s*s times the output channels followed by PixelShuffle(s): output pixel
+    (s*i + a, s*j + b) only sees inputs i-1..i+1, j-1..j+1, through kernel
+    rows a + p - s*d and columns b + p - s*d for offsets d in -1, 0, 1.
+    Both have int8 kernels, unlike ConvTranspose2d.
+    """
+    assert m.groups == 1 and m.dilation == (1, 1) and m.output_padding == (0, 0)
+    (k, _), (s, _), (p, _) = m.kernel_size, m.stride, m.padding
+    weight = m.weight  # C_in, C_out, k, k
+    c_in, c_out = weight.shape[:2]
+    if s == 1:
+        conv = nn.Conv2d(c_in, c_out, k, padding=k-1-p)
+        conv.weight.copy_(weight.flip(2, 3).transpose(0, 1))
+        conv.bias.copy_(m.bias)
+        return [conv]
+
+    assert k == 2*s and 2*p == s, 'only support kernel 2*stride with padding stride/2'
+    conv = nn.Conv2d(c_in, c_out*s*s, 3, padding=1)
+    sub = torch.zeros(c_out, s, s, c_in, 3, 3)
+    for a in range(s):
+        for b in range(s):
+            for t in range(3):
+                for u in range(3):
+                    kh, kw = a + p - s*(t-1), b + p - s*(u-1)
+                    if 0 <= kh < k and 0 <= kw < k:
+                        sub[:, a, b, :, t, u] = weight[:, :, kh, kw].t()
+    conv.weight.copy_(sub.view(c_out*s*s, c_in, 3, 3))
+    conv.bias.copy_(m.bias.repeat_interleave(s*s))
+    return [conv, nn.PixelShuffle(s)]
+
+
+@torch.no_grad()
+def conv_transpose_as_linear(m):
+    """Linear layer computing ConvTranspose2d `m` (stride 1, no padding) on a
+    1x1 input: every output pixel is a linear function of the input channels."""
+    assert m.stride == (1, 1) and m.padding == (0, 0) and m.groups == 1
+    c_in, c_out, k, _ = m.weight.shape
+    linear = nn.Linear(c_in, c_out*k*k)
+    linear.weight.copy_(m.weight.reshape(c_in, c_out*k*k).t())
+    linear.bias.copy_(m.bias.repeat_interleave(k*k))
+    return [nn.Flatten(), linear, View((-1, c_out, k, k))]
+
+
+def to_subpixel(decoder):
+    """Rewrite the transposed convolutions of a Sequential decoder with
+    `conv_transpose_as_conv`, or `conv_transpose_as_linear` right after the
+    View to a 1x1 map. A following ReLU is moved in front of the PixelShuffle
+    or View (it is elementwise), so it can be fused with the layer before."""
+    modules = list(decoder.children())
+    layers = []
+    one_by_one = False
+    i = 0
+    while i < len(modules):
+        m = modules[i]
+        if isinstance(m, nn.ConvTranspose2d):
+            if one_by_one and m.stride == (1, 1) and m.padding == (0, 0):
+                converted = conv_transpose_as_linear(m)
+            else:
+                converted = conv_transpose_as_conv(m)
+            last = max(j for j, c in enumerate(converted) if isinstance(c, (nn.Linear, nn.Conv2d)))
+            layers.extend(converted[:last+1])
+            if i+1 < len(modules) and isinstance(modules[i+1], nn.ReLU):
+                layers.append(modules[i+1])
+                i += 1
+            layers.extend(converted[last+1:])
+        else:
+            layers.append(m)
+        if isinstance(m, View):
+            one_by_one = tuple(m.size[-2:]) == (1, 1)
+        elif not isinstance(m, nn.ReLU):
+            one_by_one = False
+        i += 1
+    return nn.Sequential(*layers)
+
+
+def fuse_relu(decoder):
+    """Fuse the adjacent Linear+ReLU and Conv2d+ReLU pairs of a Sequential decoder."""
+    modules = list(decoder.children())
+    pairs = [[str(i), str(i+1)] for i in range(len(modules)-1)
+             if isinstance(modules[i], (nn.Linear, nn.Conv2d)) and isinstance(modules[i+1], nn.ReLU)]
+    if pairs:
+        tq.fuse_modules(decoder, pairs, inplace=True)
+    return decoder
+
+
+class Int8WeightConvTranspose2d(nn.Module):
+    """ConvTranspose2d whose weight is stored as per-channel int8 and
+    dequantized on use."""
+
+    def __init__(self, conv):
+        super(Int8WeightConvTranspose2d, self).__init__()
+        weight = conv.weight.detach()
+        scale = weight.abs().transpose(0, 1).flatten(1).max(1)[0].clamp(min=1e-8) / 127
+        self.register_buffer('weight', torch.quantize_per_channel(
+            weight, scale, torch.zeros_like(scale, dtype=torch.long), 1, torch.qint8))
+        self.register_buffer('bias', conv.bias.detach().clone())
+        self.stride, self.padding = conv.stride, conv.padding
+
+    def forward(self, x):
+        return nn.functional.conv_transpose2d(x, self.weight.dequantize(), self.bias,
+                                              stride=self.stride, padding=self.padding)
+
+
+def quantize_dynamic(decoder):
+    """int8 weights with activations quantized on the fly.
+
+    The Linear layers run dynamically quantized. PyTorch's dynamic int8
+    convolutions are not accurate enough, so the transposed convolutions
+    only store their weights in int8 and compute in float32.
+    """
+    decoder = copy.deepcopy(decoder).cpu().eval()
+    for name, m in decoder.named_children():
+        if isinstance(m, nn.ConvTranspose2d):
+            setattr(decoder, name, Int8WeightConvTranspose2d(m))
+    return tq.quantize_dynamic(decoder, {nn.Linear}, dtype=torch.qint8)
+
+
+@torch.no_grad()
+def quantize_static(decoder, z_dim, num_calibration=2048, batch_size=256, seed=0):
+    """int8 weights and activations, calibrated on latents drawn from N(0, I).
+
+    The transposed convolutions are rewritten as Conv2d + PixelShuffle
+    (see `conv_transpose_as_conv`), which have fast int8 CPU kernels.
+    """
+    engine = set_quantized_engine()
+    decoder = fuse_relu(to_subpixel(copy.deepcopy(decoder).cpu().eval()))
+    model = QuantizableDecoder(decoder).eval()
+    model.qconfig = tq.get_default_qconfig(engine)
+    tq.prepare(model, inplace=True)
+
+    generator = torch.Generator().manual_seed(seed)
+    for i in range(0, num_calibration, batch_size):
+        model(torch.randn(min(batch_size, num_calibration-i), z_dim, generator=generator))
+    return tq.convert(model, inplace=True)
+
+
+def quantize_decoder(decoder, z_dim, mode, **kwargs):
+    if mode == 'dynamic':
+        return quantize_dynamic(decoder)
+    elif mode == 'static':
+        return quantize_static(decoder, z_dim, **kwargs)
+    else:
+        raise NotImplementedError('only support quantize mode dynamic or static')
+
+
+def serialized_size(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+@torch.no_grad()
+def compare_decoders(float_decoder, quantized_decoder, z_dim, num_samples=1024, batch_size=64, seed=1):
+    """Image-space error, CPU latency and serialized size against float32."""
+    float_decoder = copy.deepcopy(float_decoder).cpu().eval()
+    z = torch.randn(num_samples, z_dim, generator=torch.Generator().manual_seed(seed))
+    ref = torch.sigmoid(float_decoder(z))
+    out = torch.sigmoid(quantized_decoder(z))
+    mse = (out - ref).pow(2).mean().item()
+
+    batch = z[:batch_size]
+    float_latency = time_call(float_decoder, batch)
+    quantized_latency = time_call(quantized_decoder, batch)
+    float_size = serialized_size(float_decoder)
+    quantized_size = serialized_size(quantized_decoder)
+    return {'mse':mse,
+            'max_abs_error':(out - ref).abs().max().item(),
+            'psnr':float(10*np.log10(1/max(mse, 1e-12))),
+            'batch_size':batch_size,
+            'float_latency_ms':1000*float_latency,
+            'quantized_latency_ms':1000*quantized_latency,
+            'speedup':float_latency / quantized_latency,
+            'float_bytes':float_size,
+            'quantized_bytes':quantized_size,
+            'compression':float_size / quantized_size}
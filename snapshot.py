@@ -0,0 +1,98 @@
+"""snapshot.py"""
+
+import hashlib
+import os
+import zlib
+
+import numpy as np
+import torch
+
+
+SNAPSHOT_VERSION = 1
+
+
+def _write_blob(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_snapshot(file_path, state_dict, blob_dir, fp16=False, compress=False, **meta):
+    """Write the weights in `state_dict` as a compact, deduplicated snapshot.
+
+    Every tensor is stored once in `blob_dir` under the hash of its (cast)
+    bytes, optionally zlib-compressed, and the snapshot at `file_path` is a
+    small manifest pointing to the blobs. Tensors that did not change since
+    an earlier snapshot are not written again. With `fp16`, floating point
+    tensors are stored in half precision. Extra keyword arguments (iter,
+    z_dim, ...) are kept in the manifest. Returns the number of bytes
+    written.
+    """
+    os.makedirs(blob_dir, exist_ok=True)
+    tensors = {}
+    written = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        dtype = tensor.dtype
+        if fp16 and tensor.is_floating_point():
+            tensor = tensor.half()
+        data = tensor.contiguous().numpy().tobytes()
+        key = hashlib.sha1(data).hexdigest() + ('.z' if compress else '')
+        blob_path = os.path.join(blob_dir, key)
+        if not os.path.exists(blob_path):
+            if compress:
+                data = zlib.compress(data, 1)
+            _write_blob(blob_path, data)
+            written += len(data)
+        tensors[name] = {'blob':key,
+                         'dtype':str(dtype).replace('torch.', ''),
+                         'stored_dtype':str(tensor.dtype).replace('torch.', ''),
+                         'shape':tuple(tensor.shape)}
+
+    manifest = dict(meta)
+    manifest['snapshot'] = {'version':SNAPSHOT_VERSION,
+                            'blob_dir':os.path.relpath(blob_dir, os.path.dirname(os.path.abspath(file_path))),
+                            'tensors':tensors}
+    with open(file_path, mode='wb+') as f:
+        torch.save(manifest, f)
+    return written + os.path.getsize(file_path)
+
+
+def is_snapshot(checkpoint):
+    return 'snapshot' in checkpoint
+
+
+def inflate_snapshot(checkpoint, file_path, map_location=None):
+    """Turn a loaded snapshot manifest into a regular checkpoint dict.
+
+    The weights come back in their original dtype under
+    `model_states['net']`, so the result loads like a full checkpoint
+    without optimizer state.
+    """
+    snapshot = checkpoint['snapshot']
+    if snapshot['version'] != SNAPSHOT_VERSION:
+        raise ValueError('unsupported snapshot version {}'.format(snapshot['version']))
+    blob_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), snapshot['blob_dir'])
+
+    state_dict = {}
+    for name, entry in snapshot['tensors'].items():
+        with open(os.path.join(blob_dir, entry['blob']), 'rb') as f:
+            data = f.read()
+        if entry['blob'].endswith('.z'):
+            data = zlib.decompress(data)
+        array = np.frombuffer(bytearray(data), dtype=np.dtype(entry['stored_dtype'])).reshape(entry['shape'])
+        tensor = torch.from_numpy(array).to(getattr(torch, entry['dtype']))
+        state_dict[name] = tensor.to(map_location) if map_location is not None else tensor
+
+    checkpoint = {k:v for k, v in checkpoint.items() if k != 'snapshot'}
+    checkpoint['model_states'] = {'net':state_dict}
+    return checkpoint
+
+
+def load_snapshot(file_path, map_location=None):
+    """Load a snapshot or a full checkpoint from `file_path` for evaluation."""
+    checkpoint = torch.load(file_path, map_location=map_location)
+    if is_snapshot(checkpoint):
+        checkpoint = inflate_snapshot(checkpoint, file_path, map_location)
+    return checkpoint
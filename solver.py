@@ -4,6 +4,11 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import os
+import copy
+import itertools
+import json
+import math
+import signal
 from tqdm import tqdm
 import visdom
 import numpy as np
@@ -14,77 +19,80 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchvision.utils import make_grid, save_image
 import torchvision.transforms as transforms
-
-from utils import grid2gif
-from model import BetaVAE_H, BetaVAE_B, WAE
-from dataset import return_data
-import ot
+from torch.utils.data import default_collate
+
+from utils import grid2gif, get_rng_states, set_rng_states
+from visualizer import VizWorker
+from prefetcher import DevicePrefetcher
+from model import BetaVAE_H, BetaVAE_B, WAE, get_student_decoder
+from dataset import BatchPreprocessor, ThreadedBatchLoader, benchmark_loader
+from dataset import default_image_size, get_dataset, get_split, load_dsprites, return_data, return_eval_data
+from losses import reconstruction_loss, kl_divergence, Wasserstein2_dist
+from evaluate import evaluate, iwae_log_likelihood
+from disentanglement import DisentanglementMetrics
+from quantize import quantize_decoder, compare_decoders
+from prune import split_active_dims, prune_latents, compare_pruned
+from distill import PosteriorLatents, distill_decoder, compare_student
+from snapshot import save_snapshot, load_snapshot
+from sweep import find_checkpoints, sweep_checkpoints, write_table
+from posterior import AggregatePosterior
+from tune import tune
 from torch.utils.tensorboard import SummaryWriter
 
 
-def reconstruction_loss(x, x_recon, distribution):
-    batch_size = x.size(0)
-    assert batch_size != 0
-
-    if distribution == 'bernoulli':
-        recon_loss = F.binary_cross_entropy_with_logits(x_recon, x, size_average=False).div(batch_size)
-    elif distribution == 'gaussian':
-        x_recon = F.sigmoid(x_recon)
-        recon_loss = F.mse_loss(x_recon, x, size_average=False).div(batch_size)
-    else:
-        recon_loss = None
-
-    return recon_loss
-
-
-def kl_divergence(mu, logvar):
-    batch_size = mu.size(0)
-    assert batch_size != 0
-    if mu.data.ndimension() == 4:
-        mu = mu.view(mu.size(0), mu.size(1))
-    if logvar.data.ndimension() == 4:
-        logvar = logvar.view(logvar.size(0), logvar.size(1))
-
-    klds = -0.5*(1 + logvar - mu.pow(2) - logvar.exp())
-    total_kld = klds.sum(1).mean(0, True)
-    dimension_wise_kld = klds.mean(0)
-    mean_kld = klds.mean(1).mean(0, True)
-
-    return total_kld, dimension_wise_kld, mean_kld
-
-def Wasserstein2_dist(z):
-    N, ndim = z.size()
-    a, b = np.ones((N,)) / N, np.ones((N,)) / N  # points have equal probability of 1/N
-    prior = np.random.randn(N, ndim)
-    M = ot.dist(z.data.cpu().numpy(), prior, metric='sqeuclidean')
-    G = ot.emd(a, b, M, numItermax=500000)
-    ix1, ix2 = np.nonzero(G)
-    prior_var = torch.from_numpy(prior[ix2]).to('cuda')
-    w2 = torch.sqrt(torch.mean(torch.sum(torch.pow(z - prior_var, 2), dim=1)))
-    # w2 = torch.mean(torch.norm(x - z_var, p=2, dim=1))
-    return w2
-
-class DataGather(object):
-    def __init__(self):
-        self.data = self.get_empty_data_dict()
-
-    def get_empty_data_dict(self):
-        return dict(iter=[],
-                    recon_loss=[],
-                    total_kld=[],
-                    dim_wise_kld=[],
-                    mean_kld=[],
-                    mu=[],
-                    var=[],
-                    images=[],
-                    w2_dist=[],)
-
-    def insert(self, **kwargs):
-        for key in kwargs:
-            self.data[key].append(kwargs[key])
+class MetricAccumulator(object):
+    """Running sums of training metrics kept on the training device.
+
+    `insert` only issues in-place adds into one preallocated buffer, so no
+    host sync happens during the logging window. `read` returns the window
+    averages with a single device-to-host transfer and resets the sums.
+    """
+    scalar_keys = ('recon_loss', 'total_kld', 'mean_kld', 'w2_dist')
+
+    def __init__(self, z_dim, device):
+        self.z_dim = z_dim
+        n = len(self.scalar_keys)
+        # layout: [scalars | dim_wise_kld | mu | var]
+        self.buffer = torch.zeros(n + 3*z_dim, device=device)
+        self.scalars = self.buffer[:n]
+        self.dim_wise_kld = self.buffer[n:n+z_dim]
+        self.mu = self.buffer[n+z_dim:n+2*z_dim]
+        self.var = self.buffer[n+2*z_dim:]
+        self.count = 0
+
+    def insert(self, recon_loss, total_kld=None, dim_wise_kld=None, mean_kld=None,
+               mu=None, logvar=None, w2_dist=None):
+        self.scalars[0].add_(recon_loss.detach().view(()))
+        if total_kld is not None:
+            self.scalars[1].add_(total_kld.detach().view(()))
+        if mean_kld is not None:
+            self.scalars[2].add_(mean_kld.detach().view(()))
+        if w2_dist is not None:
+            self.scalars[3].add_(w2_dist.detach().view(()))
+        if dim_wise_kld is not None:
+            self.dim_wise_kld.add_(dim_wise_kld.detach())
+        if mu is not None:
+            self.mu.add_(mu.detach().mean(0))
+        if logvar is not None:
+            self.var.add_(logvar.detach().exp().mean(0))
+        self.count += 1
+
+    def read(self):
+        if self.count == 0:
+            return None
+        values = (self.buffer / self.count).cpu()
+        n = len(self.scalar_keys)
+        summary = {key:values[i].item() for i, key in enumerate(self.scalar_keys)}
+        summary['dim_wise_kld'] = values[n:n+self.z_dim]
+        summary['mu'] = values[n+self.z_dim:n+2*self.z_dim]
+        summary['var'] = values[n+2*self.z_dim:]
+        summary['count'] = self.count
+        self.flush()
+        return summary
 
     def flush(self):
-        self.data = self.get_empty_data_dict()
+        self.buffer.zero_()
+        self.count = 0
 
 
 class Solver(object):
@@ -92,7 +100,7 @@ class Solver(object):
         self.use_cuda = args.cuda and torch.cuda.is_available()
         self.max_iter = args.max_iter
         self.global_iter = 0
-        self.device = 'cuda'
+        self.device = 'cuda' if self.use_cuda else 'cpu'
 
         self.z_dim = args.z_dim
         self.beta = args.beta
@@ -101,6 +109,7 @@ class Solver(object):
         self.C_stop_iter = args.C_stop_iter
         self.objective = args.objective
         self.model = args.model
+        self.num_z_samples = args.num_z_samples
         self.lr = args.lr
         self.beta1 = args.beta1
         self.beta2 = args.beta2
@@ -132,14 +141,14 @@ class Solver(object):
         else:
             raise NotImplementedError('only support model H or B')
 
-        if args.dataset.lower() == 'cifar10':
-            self.net = net(self.z_dim, self.nc, input_size=32).to(self.device)
-        elif args.dataset.lower() in ['church128', 'celebahq128', 'bedroom128', 'dog128']:
-            self.net = net(self.z_dim, self.nc, input_size=128).to(self.device)
-        else:
-            self.net = net(self.z_dim, self.nc).to(self.device)
-        self.optim = optim.Adam(self.net.parameters(), lr=self.lr,
-                                    betas=(self.beta1, self.beta2))
+        self.input_size = args.image_size or default_image_size(args.dataset)
+        if self.input_size not in [32, 64, 128]:
+            raise NotImplementedError('only support image size 32, 64 or 128')
+        if args.model == 'B' and self.input_size != 64:
+            raise NotImplementedError('model B only supports image size 64')
+        self.net_cls = net
+        self.build_net()
+        self.sample_decoder = None
 
         self.viz_name = args.viz_name
         self.viz_port = args.viz_port
@@ -154,8 +163,18 @@ class Solver(object):
         if not os.path.exists(self.ckpt_dir):
             os.makedirs(self.ckpt_dir, exist_ok=True)
         self.ckpt_name = args.ckpt_name
+        # position in the shuffled training data and the RNG states to resume
+        # from, see save_checkpoint
+        self.epoch = 0
+        self.epoch_position = 0
+        self.rng_states = None
         if self.ckpt_name is not None:
             self.load_checkpoint(self.ckpt_name)
+        if args.decoder_ckpt is not None:
+            self.load_student_decoder(args.decoder_ckpt)
+        # the fitted aggregate posterior is loaded on first use, see sample_latents
+        self.prior = args.prior
+        self.posterior = None
 
         self.save_output = args.save_output
         self.output_dir = os.path.join(args.output_dir, args.viz_name)
@@ -167,39 +186,71 @@ class Solver(object):
         self.gather_step = args.gather_step
         self.display_step = args.display_step
         self.save_step = args.save_step
+        self.snapshot_step = args.snapshot_step
+        self.snapshot_fp16 = args.snapshot_fp16
+        self.snapshot_compress = args.snapshot_compress
 
         self.dset_dir = args.dset_dir
         self.dataset = args.dataset
         self.batch_size = args.batch_size
-        self.data_loader = return_data(args)
-
-        self.test_batch = next(iter(self.data_loader)).to(self.device)
-
-        self.gather = DataGather()
+        self.prefetch_depth = args.prefetch_depth
+        self.dset = get_dataset(args)
+        self.data_loader = return_data(args, self.dset)
+
+        self.eval_step = args.eval_step
+        self.eval_loader = None
+        if self.eval_step or not args.train:
+            self.eval_loader = return_eval_data(args, self.dset)
+
+        self.preprocess = BatchPreprocessor(self.device, bit_packed=self.dataset.lower() == 'dsprites',
+                                            size=self.input_size)
+        # the first training batch, read in the main process so that the
+        # loader's (persistent) workers only start when they are used
+        sampler = self.data_loader.sampler
+        indices = list(itertools.islice(sampler, self.batch_size))
+        self.test_batch = self.preprocess(default_collate([sampler.data_source[i] for i in indices]))
+
+        self.gather = MetricAccumulator(self.z_dim, self.device)
+        self.meter = MetricAccumulator(self.z_dim, self.device)
+
+    def build_net(self):
+        if self.input_size == 64:
+            self.net = self.net_cls(self.z_dim, self.nc).to(self.device)
+        else:
+            self.net = self.net_cls(self.z_dim, self.nc, input_size=self.input_size).to(self.device)
+        self.optim = optim.Adam(self.net.parameters(), lr=self.lr,
+                                    betas=(self.beta1, self.beta2))
 
     def train(self):
         self.net_mode(train=True)
-        self.C_max = torch.FloatTensor([self.C_max]).to(self.device)
+        if self.viz_on:
+            self.viz_worker = VizWorker(self.net, self.writer, self.test_batch, z=self.sample_latents(36))
+        if self.rng_states is not None:
+            set_rng_states(self.rng_states)
+            self.rng_states = None
+        self.data_loader.sampler.set_epoch(self.epoch, self.epoch_position)
+        self.preempted = False
+        previous_handler = signal.signal(signal.SIGTERM, self._on_sigterm)
+        prefetcher = DevicePrefetcher(self.data_loader, self.preprocess, self.prefetch_depth)
         out = False
 
         pbar = tqdm(total=self.max_iter)
         pbar.update(self.global_iter)
         while not out:
-            for x in self.data_loader:
+            for x in self._epoch(prefetcher):
                 self.global_iter += 1
+                self.epoch_position += self.batch_size
                 pbar.update(1)
 
-                x = x.to(self.device)
-
                 if self.model in ['H', 'B']:
-                    x_recon, mu, logvar = self.net(x)
+                    x_recon, mu, logvar = self.net(x, self.num_z_samples)
                     recon_loss = reconstruction_loss(x, x_recon, self.decoder_dist)
                     total_kld, dim_wise_kld, mean_kld = kl_divergence(mu, logvar)
 
                     if self.objective == 'H':
                         loss = recon_loss + self.beta*total_kld
                     elif self.objective == 'B':
-                        C = torch.clamp(self.C_max/self.C_stop_iter*self.global_iter, 0, self.C_max.item())
+                        C = min(self.C_max/self.C_stop_iter*self.global_iter, self.C_max)
                         loss = recon_loss + self.gamma*(total_kld-C).abs()
                 elif self.model == 'WAE':
                     x_recon, z = self.net(x)
@@ -211,220 +262,362 @@ class Solver(object):
                 loss.backward()
                 self.optim.step()
 
+                if self.model in ['H', 'B']:
+                    metrics = dict(recon_loss=recon_loss, total_kld=total_kld,
+                                   dim_wise_kld=dim_wise_kld, mean_kld=mean_kld,
+                                   mu=mu, logvar=logvar)
+                else:
+                    metrics = dict(recon_loss=recon_loss, w2_dist=w2_dist)
+                if self.viz_on:
+                    self.gather.insert(**metrics)
+                self.meter.insert(**metrics)
+
                 if self.viz_on and self.global_iter%self.gather_step == 0:
-                    self.writer.add_scalar('recon-loss', recon_loss.item(), self.global_iter)
-                    if self.model == 'WAE':
-                        self.writer.add_scalar('W2-dist', w2_dist.item(), self.global_iter)
-                    else:
-                        self.writer.add_scalar('mean-kld', mean_kld.item(), self.global_iter)
-                        # self.gather.insert(iter=self.global_iter,
-                        #                    mu=mu.mean(0).data, var=logvar.exp().mean(0).data,
-                        #                    recon_loss=recon_loss.data, total_kld=total_kld.data,
-                        #                    dim_wise_kld=dim_wise_kld.data, mean_kld=mean_kld.data)
+                    self.viz_lines(self.gather.read())
 
                 if self.global_iter%self.display_step == 0:
+                    summary = self.meter.read()
                     if self.model == 'WAE':
                         pbar.write('[{}] recon_loss:{:.3f} w2_dist:{:.3f}'.format(
-                            self.global_iter, recon_loss.item(), w2_dist.item()))
+                            self.global_iter, summary['recon_loss'], summary['w2_dist']))
                     else:
                         pbar.write('[{}] recon_loss:{:.3f} total_kld:{:.3f} mean_kld:{:.3f}'.format(
-                            self.global_iter, recon_loss.item(), total_kld.item(), mean_kld.item()))
+                            self.global_iter, summary['recon_loss'], summary['total_kld'], summary['mean_kld']))
 
-                    # var = logvar.exp().mean(0).data
                     # var_str = ''
-                    # for j, var_j in enumerate(var):
+                    # for j, var_j in enumerate(summary['var']):
                     #     var_str += 'var{}:{:.4f} '.format(j+1, var_j)
                     # pbar.write(var_str)
 
                     # if self.objective == 'B':
-                    #     pbar.write('C:{:.3f}'.format(C.item()))
+                    #     pbar.write('C:{:.3f}'.format(C))
+
+                    data_stats = prefetcher.stats()
+                    self.writer.add_scalar('data/starved-fraction', data_stats['starved_fraction'], self.global_iter)
+                    self.writer.add_scalar('data/wait-time', data_stats['wait_time'], self.global_iter)
+                    if getattr(self.dset, 'cache', None) is not None:
+                        cache_stats = self.dset.cache.stats()
+                        self.writer.add_scalar('data/cache-hit-rate', cache_stats['hit_rate'], self.global_iter)
+                        self.writer.add_scalar('data/cache-used', cache_stats['used'], self.global_iter)
 
                     if self.viz_on:
-                        self.viz_reconstruction()
-                        # self.viz_lines()
-                        self.viz_rand_samples()
-                        # self.gather.flush()
+                        self.viz_worker.submit(self.global_iter, self.net)
 
                     # if self.viz_on or self.save_output:
                     #     self.viz_traverse()
 
+                if self.eval_step and self.global_iter%self.eval_step == 0:
+                    self.evaluate(log=pbar.write)
+
                 if self.global_iter%self.save_step == 0:
                     self.save_checkpoint('last')
                     pbar.write('Saved checkpoint(iter:{})'.format(self.global_iter))
 
-                if self.global_iter%50000 == 0:
-                    self.save_checkpoint(str(self.global_iter))
+                if self.snapshot_step and self.global_iter%self.snapshot_step == 0:
+                    self.save_snapshot(str(self.global_iter))
 
-                if self.global_iter >= self.max_iter:
+                if self.preempted or self.global_iter >= self.max_iter:
                     out = True
                     break
-
+            else:
+                if self.preempted:
+                    out = True
+                else:
+                    self.epoch += 1
+                    self.epoch_position = 0
+
+        signal.signal(signal.SIGTERM, previous_handler)
+        if self.preempted:
+            self.save_checkpoint('last')
+            pbar.write('Received SIGTERM, saved checkpoint(iter:{})'.format(self.global_iter))
+        prefetcher.close()
+        data_stats = prefetcher.stats()
+        pbar.write('Waited for data in {}/{} steps ({:.1f}s)'.format(
+            data_stats['starved'], data_stats['batches'], data_stats['wait_time']))
+        if getattr(self.dset, 'cache', None) is not None:
+            cache_stats = self.dset.cache.stats()
+            pbar.write('Image cache: hit rate {:.3f}, {}/{} slots used, {} evictions'.format(
+                cache_stats['hit_rate'], cache_stats['used'], cache_stats['slots'], cache_stats['evictions']))
+        if self.viz_on:
+            self.viz_worker.close()
+            if self.viz_worker.dropped:
+                pbar.write('Skipped {} visualizations while the worker was busy'.format(self.viz_worker.dropped))
+            if self.viz_worker.failed:
+                pbar.write('{} visualizations failed to render'.format(self.viz_worker.failed))
         pbar.write("[Training Finished]")
         pbar.close()
 
-    def viz_reconstruction(self):
+    def _on_sigterm(self, signum, frame):
+        # only flag it; the checkpoint is written at the next step boundary
+        self.preempted = True
+
+    def _epoch(self, prefetcher):
+        """Batches of one epoch. The loader workers usually receive the
+        SIGTERM as well, so after it their failure ends the epoch early
+        instead of the run."""
+        try:
+            yield from prefetcher
+        except RuntimeError:
+            if not self.preempted:
+                raise
+
+    def quantize(self, mode, log=print):
+        """Swap in an int8 CPU decoder for `rand_samples` and report its cost."""
         self.net_mode(train=False)
-        x_recon, mu, logvar = self.net(self.test_batch)
-        x_recon = F.sigmoid(x_recon)
-        images = make_grid(torch.cat([self.test_batch[:8], x_recon[:8]]).cpu(), nrow=8)
-        self.writer.add_image('recons', images, self.global_iter)
+        self.sample_decoder = quantize_decoder(self.net.decoder, self.z_dim, mode)
+        report = compare_decoders(self.net.decoder, self.sample_decoder, self.z_dim)
+        log('[{}] {} int8 decoder: mse:{:.2e} psnr:{:.1f}dB latency:{:.2f}ms->{:.2f}ms size:{:.2f}MB->{:.2f}MB'.format(
+            self.global_iter, mode, report['mse'], report['psnr'],
+            report['float_latency_ms'], report['quantized_latency_ms'],
+            report['float_bytes']/2**20, report['quantized_bytes']/2**20))
+        # dynamic mode computes the convolutions in float32 and is there to
+        # save memory; static mode has to pay for itself in speed
+        if mode == 'static' and report['quantized_latency_ms'] > report['float_latency_ms']:
+            log('[{}] warning: the {} int8 decoder is slower than float32, sampling with the float32 decoder'.format(
+                self.global_iter, mode))
+            self.sample_decoder = None
+        return report
+
+    def prune(self, threshold, log=print):
+        """Export a model without the latent units whose KL is below `threshold`."""
+        if self.model == 'WAE':
+            raise NotImplementedError('pruning needs the per-dimension KL of model H or B')
+        self.net_mode(train=False)
+        results = evaluate(self.net, self.eval_loader, self.model, self.decoder_dist, self.device,
+                           self.preprocess)
+        active, inactive = split_active_dims(results['dim_wise_kld'], threshold)
+        log('dim-wise kld: ' + ' '.join('z{}:{:.4f}'.format(j, v) for j, v in enumerate(results['dim_wise_kld'])))
+        if len(active) == 0:
+            raise ValueError('no latent unit has KL above {}'.format(threshold))
+
+        pruned = prune_latents(self.net, active)
+        report = compare_pruned(self.net, pruned, active, self.test_batch)
         self.net_mode(train=True)
+        log('kept {}/{} latent units, parameters {}->{}, max abs diff encode:{:.2e} decode:{:.2e}'.format(
+            report['active_dims'], report['z_dim'], report['full_parameters'], report['pruned_parameters'],
+            report['encode_max_abs_diff'], report['decode_max_abs_diff']))
+        log('per sec encode:{:.0f}->{:.0f} sample:{:.0f}->{:.0f} traverse:{:.1f}->{:.1f}'.format(
+            report['full_encode_per_sec'], report['pruned_encode_per_sec'],
+            report['full_sample_per_sec'], report['pruned_sample_per_sec'],
+            report['full_traverse_per_sec'], report['pruned_traverse_per_sec']))
 
-    def viz_lines(self):
+        states = {'iter':self.global_iter,
+                  'z_dim':len(active),
+                  'active_dims':active.tolist(),
+                  'dim_wise_kld':results['dim_wise_kld'],
+                  'model_states':{'net':pruned.state_dict()}}
+        file_path = os.path.join(self.ckpt_dir, '{}_pruned'.format(self.ckpt_name))
+        with open(file_path, mode='wb+') as f:
+            torch.save(states, f)
+        log("=> saved pruned model '{}' (z_dim {})".format(file_path, len(active)))
+        return report
+
+    def distill(self, width, depth, iters, batch_size, lr, log=print):
+        """Distill the decoder into a narrower/shallower student for sampling."""
+        if depth is None:
+            # the teacher's number of x2 upsampling layers
+            depth = int(math.log2(self.input_size // 4))
         self.net_mode(train=False)
-        recon_losses = torch.stack(self.gather.data['recon_loss']).cpu()
-
-        iters = torch.Tensor(self.gather.data['iter'])
+        student = get_student_decoder(self.nc, self.z_dim, self.input_size, width, depth).to(self.device)
+        posterior = PosteriorLatents(self.net.encoder, self.data_loader, self.z_dim, self.preprocess,
+                                     stochastic=self.model != 'WAE')
+        distill_decoder(self.net.decoder, student, self.z_dim, self.device, posterior,
+                        iters=iters, batch_size=batch_size, lr=lr, log=log)
+        report = compare_student(self.net.decoder, student, self.z_dim, self.device, posterior)
+        self.net_mode(train=True)
+        log('student(width {}, depth {}): prior psnr:{:.1f}dB posterior psnr:{:.1f}dB samples/sec {:.0f}->{:.0f} parameters {}->{}'.format(
+            width, depth, report['prior_psnr'], report['posterior_psnr'],
+            report['teacher_samples_per_sec'], report['student_samples_per_sec'],
+            report['teacher_parameters'], report['student_parameters']))
+
+        name = '{}_student_w{}_d{}'.format(self.ckpt_name, width, depth)
+        states = {'iter':self.global_iter, 'width':width, 'depth':depth,
+                  'report':report, 'decoder':student.state_dict()}
+        with open(os.path.join(self.ckpt_dir, name), mode='wb+') as f:
+            torch.save(states, f)
+        with open(os.path.join(self.output_dir, name+'.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        log("=> saved student decoder '{}'".format(os.path.join(self.ckpt_dir, name)))
+        return report
 
-        if self.model == 'WAE':
-            w2_dist = torch.Tensor(self.gather.data['w2_dist']).cpu()
-        else:
-            mus = torch.stack(self.gather.data['mu']).cpu()
-            vars = torch.stack(self.gather.data['var']).cpu()
-
-            dim_wise_klds = torch.stack(self.gather.data['dim_wise_kld'])
-            mean_klds = torch.stack(self.gather.data['mean_kld'])
-            total_klds = torch.stack(self.gather.data['total_kld'])
-            klds = torch.cat([dim_wise_klds, mean_klds, total_klds], 1).cpu()
-
-            legend = []
-            for z_j in range(self.z_dim):
-                legend.append('z_{}'.format(z_j))
-            legend.append('mean')
-            legend.append('total')
-
-        if self.win_recon is None:
-            self.win_recon = self.viz.line(
-                                        X=iters,
-                                        Y=recon_losses,
-                                        env=self.viz_name+'_lines',
-                                        opts=dict(
-                                            width=400,
-                                            height=400,
-                                            xlabel='iteration',
-                                            title='reconsturction loss',))
+    def load_student_decoder(self, filename):
+        """Replace the decoder with a distilled student (used by rand_samples/viz_traverse)."""
+        file_path = os.path.join(self.ckpt_dir, filename)
+        checkpoint = torch.load(file_path, map_location=self.device)
+        student = get_student_decoder(self.nc, self.z_dim, self.input_size,
+                                      checkpoint['width'], checkpoint['depth'])
+        student.load_state_dict(checkpoint['decoder'])
+        self.net.decoder = student.to(self.device)
+        print("=> loaded student decoder '{}'".format(file_path))
+
+    def tune(self, args, log=print):
+        """Measure step time, loading rate and peak memory on this machine and
+        recommend the fastest batch size / loader / thread configuration."""
+        def make_loader(kind, num_workers, batch_size):
+            loader_args = copy.copy(args)
+            loader_args.loader, loader_args.num_workers, loader_args.batch_size = kind, num_workers, batch_size
+            return return_data(loader_args, self.dset)
+
+        def sample_batch(batch_size):
+            repeats = -(-batch_size // len(self.test_batch))
+            return self.test_batch.repeat(repeats, 1, 1, 1)[:batch_size]
+
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        powers = [2**i for i in range(num_cores.bit_length()) if 2**i <= num_cores]
+        batch_sizes = [int(b) for b in args.tune_batch_sizes.split(',')]
+        worker_counts = [0] + powers
+        thread_counts = powers if self.device == 'cpu' else [torch.get_num_threads()]
+        memory_limit = args.tune_memory_mb or None
+
+        configs, best = tune(self.net, sample_batch, make_loader, self.model, self.decoder_dist, self.device,
+                             batch_sizes, worker_counts, thread_counts, memory_limit_mb=memory_limit, log=log)
+        file_path = os.path.join(self.output_dir, 'tune.json')
+        with open(file_path, 'w') as f:
+            json.dump({'best':best, 'configs':configs}, f, indent=2)
+        if best is None:
+            log('[tune] no configuration fits in the memory limit')
         else:
-            self.win_recon = self.viz.line(
-                                        X=iters,
-                                        Y=recon_losses,
-                                        env=self.viz_name+'_lines',
-                                        win=self.win_recon,
-                                        update='append',
-                                        opts=dict(
-                                            width=400,
-                                            height=400,
-                                            xlabel='iteration',
-                                            title='reconsturction loss',))
+            log('[tune] {:.0f} samples/sec ({:.0f}MB) with: --batch_size {} --loader {} --num_workers {} --num_threads {}'.format(
+                best['samples_per_sec'], best['memory_mb'], best['batch_size'], best['loader'],
+                best['num_workers'], best['num_threads']))
+        log("=> wrote '{}'".format(file_path))
+        return best
+
+    def benchmark_loaders(self, args, num_batches=100, log=print):
+        """Compare worker processes and a decoding thread pool at equal core counts."""
+        from torch.utils.data import DataLoader, RandomSampler
+        train_data = get_split(self.dset, args, 'train')
+        loaders = {'processes':DataLoader(train_data, batch_size=self.batch_size, shuffle=True,
+                                          num_workers=args.num_workers, pin_memory=True, drop_last=True),
+                   'threads':ThreadedBatchLoader(train_data, self.batch_size, args.num_workers,
+                                                 sampler=RandomSampler(train_data))}
+        results = {}
+        for name, loader in loaders.items():
+            results[name] = benchmark_loader(loader, num_batches)
+            log('{} x{}: {:.0f} images/sec, {:.0f} MB resident'.format(
+                name, args.num_workers, results[name]['images_per_sec'], results[name]['rss_mb']))
+            del loader
+        return results
+
+    def evaluate(self, log=print):
+        self.net_mode(train=False)
+        try:
+            results = evaluate(self.net, self.eval_loader, self.model, self.decoder_dist, self.device,
+                               self.preprocess)
+        except RuntimeError:
+            # the eval loader workers got the SIGTERM too, see _epoch
+            if not self.preempted:
+                raise
+            self.net_mode(train=True)
+            log('[{}] eval skipped after SIGTERM'.format(self.global_iter))
+            return None
+        self.net_mode(train=True)
+
+        self.writer.add_scalar('eval/recon-loss', results['recon_loss'], self.global_iter)
         if self.model == 'WAE':
-            if self.win_w2_dist is None:
-                self.win_w2_dist = self.viz.line(
-                                            X=iters,
-                                            Y=w2_dist,
-                                            env=self.viz_name+'_lines',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                xlabel='iteration',
-                                                title='Wasserstein2 distance',))
-            else:
-                self.win_w2_dist = self.viz.line(
-                                            X=iters,
-                                            Y=w2_dist,
-                                            env=self.viz_name+'_lines',
-                                            win=self.win_w2_dist,
-                                            update='append',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                xlabel='iteration',
-                                                title='Wasserstein2 divergence',))
+            self.writer.add_scalar('eval/W2-dist', results['w2_dist'], self.global_iter)
+            log('[{}] eval({}) recon_loss:{:.3f} w2_dist:{:.3f}'.format(
+                self.global_iter, results['n'], results['recon_loss'], results['w2_dist']))
         else:
-            if self.win_kld is None:
-                self.win_kld = self.viz.line(
-                                            X=iters,
-                                            Y=klds,
-                                            env=self.viz_name+'_lines',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                legend=legend,
-                                                xlabel='iteration',
-                                                title='kl divergence',))
-            else:
-                self.win_kld = self.viz.line(
-                                            X=iters,
-                                            Y=klds,
-                                            env=self.viz_name+'_lines',
-                                            win=self.win_kld,
-                                            update='append',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                legend=legend,
-                                                xlabel='iteration',
-                                                title='kl divergence',))
-
-            if self.win_mu is None:
-                self.win_mu = self.viz.line(
-                                            X=iters,
-                                            Y=mus,
-                                            env=self.viz_name+'_lines',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                legend=legend[:self.z_dim],
-                                                xlabel='iteration',
-                                                title='posterior mean',))
+            self.writer.add_scalar('eval/total-kld', results['total_kld'], self.global_iter)
+            self.writer.add_scalar('eval/mean-kld', results['mean_kld'], self.global_iter)
+            self.writer.add_scalar('eval/elbo', results['elbo'], self.global_iter)
+            self.writer.add_scalars('eval/dim-wise-kld',
+                                    {'z_{}'.format(j):v for j, v in enumerate(results['dim_wise_kld'])},
+                                    self.global_iter)
+            log('[{}] eval({}) recon_loss:{:.3f} total_kld:{:.3f} elbo:{:.3f}'.format(
+                self.global_iter, results['n'], results['recon_loss'], results['total_kld'], results['elbo']))
+        return results
+
+    def sweep(self, num_procs, max_images, num_samples=64, log=print):
+        """Evaluate every periodic checkpoint/snapshot of this run in parallel.
+
+        Writes <output_dir>/sweep/sweep.csv, one sample grid per checkpoint
+        and `sweep/*` TensorBoard scalars indexed by iteration.
+        """
+        checkpoints = find_checkpoints(self.ckpt_dir)
+        if not checkpoints:
+            log("=> no checkpoints to sweep in '{}'".format(self.ckpt_dir))
+            return []
+
+        images, n = [], 0
+        for x in self.eval_loader:
+            images.append(x[:max_images - n])
+            n += len(images[-1])
+            if n >= max_images:
+                break
+        images = torch.cat(images)
+
+        output_dir = os.path.join(self.output_dir, 'sweep')
+        os.makedirs(output_dir, exist_ok=True)
+        spec = {'net_cls':self.net_cls, 'z_dim':self.z_dim, 'nc':self.nc, 'input_size':self.input_size,
+                'model':self.model, 'decoder_dist':self.decoder_dist,
+                'bit_packed':self.dataset.lower() == 'dsprites', 'device':self.device,
+                'batch_size':self.eval_loader.batch_size, 'num_samples':num_samples, 'seed':0,
+                'output_dir':output_dir}
+
+        rows = []
+        for results in sweep_checkpoints(checkpoints, images, spec, num_procs):
+            rows.append(results)
+            it = results['iter']
+            self.writer.add_scalar('sweep/recon-loss', results['recon_loss'], it)
+            if self.model == 'WAE':
+                self.writer.add_scalar('sweep/W2-dist', results['w2_dist'], it)
+                log('[{}] sweep({}) recon_loss:{:.3f} w2_dist:{:.3f}'.format(
+                    it, results['n'], results['recon_loss'], results['w2_dist']))
             else:
-                self.win_mu = self.viz.line(
-                                            X=iters,
-                                            Y=vars,
-                                            env=self.viz_name+'_lines',
-                                            win=self.win_mu,
-                                            update='append',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                legend=legend[:self.z_dim],
-                                                xlabel='iteration',
-                                                title='posterior mean',))
-
-            if self.win_var is None:
-                self.win_var = self.viz.line(
-                                            X=iters,
-                                            Y=vars,
-                                            env=self.viz_name+'_lines',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                legend=legend[:self.z_dim],
-                                                xlabel='iteration',
-                                                title='posterior variance',))
-            else:
-                self.win_var = self.viz.line(
-                                            X=iters,
-                                            Y=vars,
-                                            env=self.viz_name+'_lines',
-                                            win=self.win_var,
-                                            update='append',
-                                            opts=dict(
-                                                width=400,
-                                                height=400,
-                                                legend=legend[:self.z_dim],
-                                                xlabel='iteration',
-                                                title='posterior variance',))
-        self.net_mode(train=True)
-
-    def viz_rand_samples(self):
-        np.random.seed(123)
-        z = torch.from_numpy(np.random.randn(36, self.z_dim).astype(np.float32)).to(self.device)
+                self.writer.add_scalar('sweep/total-kld', results['total_kld'], it)
+                self.writer.add_scalar('sweep/elbo', results['elbo'], it)
+                self.writer.add_scalars('sweep/dim-wise-kld',
+                                        {'z_{}'.format(j):v for j, v in enumerate(results['dim_wise_kld'])}, it)
+                log('[{}] sweep({}) recon_loss:{:.3f} total_kld:{:.3f} elbo:{:.3f}'.format(
+                    it, results['n'], results['recon_loss'], results['total_kld'], results['elbo']))
+        write_table(rows, os.path.join(output_dir, 'sweep.csv'))
+        log("=> wrote '{}'".format(os.path.join(output_dir, 'sweep.csv')))
+        return rows
+
+    def log_likelihood(self, num_samples, memory_budget, log=print):
         self.net_mode(train=False)
-        with torch.no_grad():
-            samples = F.sigmoid(self.net.decoder(z)).cpu()
-        self.writer.add_image('rand_samples', make_grid(samples, nrow=6), self.global_iter)
+        results = iwae_log_likelihood(self.net, self.eval_loader, self.decoder_dist, self.device,
+                                      num_samples=num_samples, memory_budget=memory_budget,
+                                      preprocess=self.preprocess)
+        self.net_mode(train=True)
 
+        self.writer.add_scalar('eval/iwae-log-likelihood', results['log_likelihood'], self.global_iter)
+        log('[{}] eval({}) iwae(K={}, chunk={}) log_likelihood:{:.3f} bits_per_dim:{:.4f}'.format(
+            self.global_iter, results['n'], results['num_samples'], results['chunk'],
+            results['log_likelihood'], results['bits_per_dim']))
+        return results
+
+    def disentanglement(self, log=print):
+        if self.dataset.lower() != 'dsprites':
+            raise NotImplementedError('disentanglement metrics need the dSprites factors')
+        latents_classes = load_dsprites(self.dset_dir)['latents_classes']
+        metrics = DisentanglementMetrics(self.net, self.dset.data_tensor, latents_classes, self.preprocess)
+        results = metrics.compute()
         self.net_mode(train=True)
 
+        for key in ['beta_vae_eval_accuracy', 'factor_vae_eval_accuracy', 'mig']:
+            self.writer.add_scalar('disentanglement/'+key, results[key], self.global_iter)
+        log('[{}] beta_vae:{:.3f} factor_vae:{:.3f} mig:{:.3f}'.format(
+            self.global_iter, results['beta_vae_eval_accuracy'],
+            results['factor_vae_eval_accuracy'], results['mig']))
+        return results
+
+    def viz_lines(self, summary):
+        self.writer.add_scalar('recon-loss', summary['recon_loss'], self.global_iter)
+        if self.model == 'WAE':
+            self.writer.add_scalar('W2-dist', summary['w2_dist'], self.global_iter)
+            return
+
+        self.writer.add_scalar('mean-kld', summary['mean_kld'], self.global_iter)
+        self.writer.add_scalar('total-kld', summary['total_kld'], self.global_iter)
+        for name, values in [('dim-wise-kld', summary['dim_wise_kld']),
+                             ('posterior-mean', summary['mu']),
+                             ('posterior-variance', summary['var'])]:
+            self.writer.add_scalars(name, {'z_{}'.format(j):v for j, v in enumerate(values.tolist())},
+                                    self.global_iter)
+
     def viz_traverse(self, limit=3, inter=2/3, loc=-1):
         self.net_mode(train=False)
         import random
@@ -433,11 +626,11 @@ class Solver(object):
         encoder = self.net.encoder
         interpolation = torch.arange(-limit, limit+0.1, inter)
 
-        n_dsets = len(self.data_loader.dataset)
+        n_dsets = len(self.dset)
         rand_idx = random.randint(1, n_dsets-1)
 
-        random_img = self.data_loader.dataset.__getitem__(rand_idx)
-        random_img = random_img.unsqueeze(0).to(self.device)
+        random_img = self.dset.__getitem__(rand_idx)
+        random_img = self.preprocess(random_img.unsqueeze(0))
         random_img_z = encoder(random_img)[:, :self.z_dim]
 
         random_z = torch.rand(1, self.z_dim, device=self.device)
@@ -447,20 +640,20 @@ class Solver(object):
             fixed_idx2 = 332800 # ellipse
             fixed_idx3 = 578560 # heart
 
-            fixed_img1 = self.data_loader.dataset.__getitem__(fixed_idx1).to(self.device).unsqueeze(0)
+            fixed_img1 = self.preprocess(self.dset.__getitem__(fixed_idx1).unsqueeze(0))
             fixed_img_z1 = encoder(fixed_img1)[:, :self.z_dim]
 
-            fixed_img2 = self.data_loader.dataset.__getitem__(fixed_idx2).to(self.device).unsqueeze(0)
+            fixed_img2 = self.preprocess(self.dset.__getitem__(fixed_idx2).unsqueeze(0))
             fixed_img_z2 = encoder(fixed_img2)[:, :self.z_dim]
 
-            fixed_img3 = self.data_loader.dataset.__getitem__(fixed_idx3).to(self.device).unsqueeze(0)
+            fixed_img3 = self.preprocess(self.dset.__getitem__(fixed_idx3).unsqueeze(0))
             fixed_img_z3 = encoder(fixed_img3)[:, :self.z_dim]
 
             Z = {'fixed_square':fixed_img_z1, 'fixed_ellipse':fixed_img_z2,
                  'fixed_heart':fixed_img_z3, 'random_img':random_img_z}
         else:
             fixed_idx = 0
-            fixed_img = self.data_loader.dataset.__getitem__(fixed_idx).to(self.device).unsqueeze(0)
+            fixed_img = self.preprocess(self.dset.__getitem__(fixed_idx).unsqueeze(0))
             fixed_img_z = encoder(fixed_img)[:, :self.z_dim]
 
             Z = {'fixed_img':fixed_img_z, 'random_img':random_img_z, 'random_z':random_z}
@@ -489,12 +682,8 @@ class Solver(object):
             output_dir = os.path.join(self.output_dir, str(self.global_iter))
             os.makedirs(output_dir, exist_ok=True)
             gifs = torch.cat(gifs)
-            if self.dataset == 'cifar10':
-                gifs = gifs.view(len(Z), self.z_dim, len(interpolation), self.nc, 32, 32).transpose(1, 2)
-            elif self.dataset in ['church128', 'celebahq128', 'bedroom128', 'dog128']:
-                gifs = gifs.view(len(Z), self.z_dim, len(interpolation), self.nc, 128, 128).transpose(1, 2)
-            else:
-                gifs = gifs.view(len(Z), self.z_dim, len(interpolation), self.nc, 64, 64).transpose(1, 2)
+            gifs = gifs.view(len(Z), self.z_dim, len(interpolation), self.nc,
+                             self.input_size, self.input_size).transpose(1, 2)
             for i, key in enumerate(Z.keys()):
                 for j, val in enumerate(interpolation):
                     save_image(tensor=gifs[i][j].cpu(),
@@ -506,16 +695,70 @@ class Solver(object):
 
         self.net_mode(train=True)
 
+    def fit_posterior(self, args, log=print):
+        """One pass over the dataset fitting the aggregate posterior, saved
+        as '<ckpt_name>_posterior' for sampling with --prior."""
+        from torch.utils.data import DataLoader
+        loader = DataLoader(self.dset, batch_size=args.eval_batch_size, shuffle=False,
+                            num_workers=args.eval_num_workers, pin_memory=True)
+        posterior = AggregatePosterior(self.z_dim, self.device,
+                                       reservoir_size=args.posterior_reservoir if args.posterior_components else 0,
+                                       seed=args.seed)
+        self.net_mode(train=False)
+        with torch.no_grad():
+            for x in tqdm(loader, leave=False):
+                distributions = self.net._encode(self.preprocess(x))
+                if self.model == 'WAE':
+                    posterior.accumulate(distributions)
+                else:
+                    posterior.accumulate(distributions[:, :self.z_dim], distributions[:, self.z_dim:])
+        posterior.finalize(args.posterior_components)
+        self.posterior = posterior
+
+        file_path = self.posterior_path()
+        with open(file_path, mode='wb+') as f:
+            torch.save(posterior.state_dict(), f)
+        log('[{}] aggregate posterior of {} images: |mean|:{:.3f} mean var:{:.3f}{}'.format(
+            self.global_iter, posterior.stats.n, posterior.mean.norm().item(),
+            posterior.cov.diagonal().mean().item(),
+            ' ({}-component mixture)'.format(len(posterior.gmm[0])) if posterior.gmm else ''))
+        log("=> saved aggregate posterior '{}'".format(file_path))
+        return posterior
+
+    def posterior_path(self):
+        # runs trained from scratch save their checkpoints as 'last'
+        return os.path.join(self.ckpt_dir, '{}_posterior'.format(self.ckpt_name or 'last'))
+
+    def load_posterior(self):
+        file_path = self.posterior_path()
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError("no aggregate posterior at '{}', fit one with --mode posterior".format(file_path))
+        self.posterior = AggregatePosterior.from_state_dict(torch.load(file_path))
+        print("=> loaded aggregate posterior '{}'".format(file_path))
+
+    def sample_latents(self, num_samples, seed=123, device=None):
+        """Latents for rand_samples and the visualizer, from N(0, I) or the
+        fitted aggregate posterior (--prior gaussian/gmm)."""
+        device = device or self.device
+        if self.prior == 'normal':
+            z = np.random.RandomState(seed).randn(num_samples, self.z_dim).astype(np.float32)
+            return torch.from_numpy(z).to(device)
+        if self.posterior is None:
+            self.load_posterior()
+        return self.posterior.sample(num_samples, self.prior, seed=seed, device=device)
+
     def rand_samples(self, num_samples):
         import numpy as np
         from PIL import Image
         import matplotlib.pyplot as plt
         self.net_mode(train=False)
-        np.random.seed(123)
-        z = torch.from_numpy(np.random.randn(num_samples, self.z_dim).astype(np.float32)).to(self.device)
+        decoder, device = self.net.decoder, self.device
+        if self.sample_decoder is not None:
+            decoder, device = self.sample_decoder, 'cpu'
+        z = self.sample_latents(num_samples, device=device)
         # z = torch.randn(num_samples, self.z_dim, device=self.device)
         with torch.no_grad():
-            out = F.sigmoid(self.net.decoder(z))
+            out = F.sigmoid(decoder(z))
         self.net_mode(train=True)
         out = out.cpu()
         grid = make_grid(out[:36], nrow=6, normalize=True)
@@ -523,8 +766,11 @@ class Solver(object):
         plt.show()
         out = out.numpy().transpose([0, 2, 3, 1])
         out = (out * 255).astype(np.uint8)
-        if self.dataset in ['cifar10', 'church128', 'celebahq128', 'bedroom128', 'dog128']:
-            np.save('img_seed_{}_betavae.npy'.format(self.dataset), out)
+        if self.input_size != 64:
+            name = self.dataset
+            if self.input_size != default_image_size(self.dataset):
+                name += str(self.input_size)
+            np.save('img_seed_{}_betavae.npy'.format(name), out)
             return out
         else:
             out128 = []
@@ -552,10 +798,20 @@ class Solver(object):
                       'kld':self.win_kld,
                       'mu':self.win_mu,
                       'var':self.win_var,}
+        # everything needed to continue with the exact next batch: the
+        # sampler position, the RNG states and the capacity schedule
+        data_states = {'epoch':self.epoch,
+                       'position':self.epoch_position}
+        capacity_states = {'C_max':self.C_max,
+                           'C_stop_iter':self.C_stop_iter,
+                           'C':min(self.C_max/self.C_stop_iter*self.global_iter, self.C_max)}
         states = {'iter':self.global_iter,
                   'win_states':win_states,
                   'model_states':model_states,
-                  'optim_states':optim_states}
+                  'optim_states':optim_states,
+                  'data_states':data_states,
+                  'rng_states':get_rng_states(),
+                  'capacity_states':capacity_states}
 
         file_path = os.path.join(self.ckpt_dir, filename)
         with open(file_path, mode='wb+') as f:
@@ -563,17 +819,39 @@ class Solver(object):
         if not silent:
             print("=> saved checkpoint '{}' (iter {})".format(file_path, self.global_iter))
 
+    def save_snapshot(self, filename):
+        """Weights-only snapshot sharing a blob store with the other snapshots;
+        only 'last' keeps the optimizer and resume state."""
+        file_path = os.path.join(self.ckpt_dir, filename)
+        return save_snapshot(file_path, self.net.state_dict(), os.path.join(self.ckpt_dir, 'blobs'),
+                             fp16=self.snapshot_fp16, compress=self.snapshot_compress,
+                             iter=self.global_iter, z_dim=self.z_dim)
+
     def load_checkpoint(self, filename):
         file_path = os.path.join(self.ckpt_dir, filename)
         if os.path.isfile(file_path):
-            checkpoint = torch.load(file_path)
+            checkpoint = load_snapshot(file_path, map_location=self.device)
             self.global_iter = checkpoint['iter']
-            self.win_recon = checkpoint['win_states']['recon']
-            self.win_kld = checkpoint['win_states']['kld']
-            self.win_var = checkpoint['win_states']['var']
-            self.win_mu = checkpoint['win_states']['mu']
+            if checkpoint.get('z_dim', self.z_dim) != self.z_dim:
+                # pruned checkpoints carry fewer latent units than --z_dim
+                self.z_dim = checkpoint['z_dim']
+                self.build_net()
+            if 'win_states' in checkpoint:
+                self.win_recon = checkpoint['win_states']['recon']
+                self.win_kld = checkpoint['win_states']['kld']
+                self.win_var = checkpoint['win_states']['var']
+                self.win_mu = checkpoint['win_states']['mu']
             self.net.load_state_dict(checkpoint['model_states']['net'])
-            self.optim.load_state_dict(checkpoint['optim_states']['optim'])
+            if 'optim_states' in checkpoint:
+                self.optim.load_state_dict(checkpoint['optim_states']['optim'])
+            if 'data_states' in checkpoint:
+                self.epoch = checkpoint['data_states']['epoch']
+                self.epoch_position = checkpoint['data_states']['position']
+            if 'rng_states' in checkpoint:
+                self.rng_states = checkpoint['rng_states']
+            if 'capacity_states' in checkpoint:
+                self.C_max = checkpoint['capacity_states']['C_max']
+                self.C_stop_iter = checkpoint['capacity_states']['C_stop_iter']
             print("=> loaded checkpoint '{} (iter {})'".format(file_path, self.global_iter))
         else:
             print("=> no checkpoint found at '{}'".format(file_path))
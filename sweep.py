@@ -0,0 +1,119 @@
+"""sweep.py"""
+
+import csv
+import os
+
+import torch
+import torch.multiprocessing as mp
+from torchvision.utils import save_image
+
+from dataset import BatchPreprocessor
+from evaluate import evaluate
+from snapshot import load_snapshot
+
+
+def find_checkpoints(ckpt_dir):
+    """(iteration, path) of every periodic checkpoint or snapshot in `ckpt_dir`."""
+    found = []
+    for name in os.listdir(ckpt_dir):
+        path = os.path.join(ckpt_dir, name)
+        if name.isdigit() and os.path.isfile(path):
+            found.append((int(name), path))
+    return sorted(found)
+
+
+def partition_cores(num_procs, cores=None):
+    """Split the usable cores into `num_procs` disjoint, near-equal groups."""
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    num_procs = max(1, min(num_procs, len(cores)))
+    return [cores[i::num_procs] for i in range(num_procs)]
+
+
+_worker = {}
+
+
+def _init_worker(images, spec, core_groups, counter):
+    with counter.get_lock():
+        rank = counter.value
+        counter.value += 1
+    cores = core_groups[rank % len(core_groups)]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    device = spec['device']
+    if device == 'cuda':
+        device = 'cuda:{}'.format(rank % torch.cuda.device_count())
+    _worker.update(spec, images=images, device=device, rank=rank,
+                   preprocess=BatchPreprocessor(device, spec['bit_packed'], spec['input_size']))
+
+
+def _build_net(z_dim):
+    w = _worker
+    if w['input_size'] == 64:
+        net = w['net_cls'](z_dim, w['nc'])
+    else:
+        net = w['net_cls'](z_dim, w['nc'], input_size=w['input_size'])
+    return net.to(w['device']).eval()
+
+
+def _evaluate_checkpoint(job):
+    """Held-out metrics and a sample grid of one checkpoint, in a worker."""
+    iteration, path = job
+    w = _worker
+    checkpoint = load_snapshot(path, map_location=w['device'])
+    z_dim = checkpoint.get('z_dim', w['z_dim'])
+    net = _build_net(z_dim)
+    net.load_state_dict(checkpoint['model_states']['net'])
+
+    images = w['images']
+    batches = (images[i:i+w['batch_size']] for i in range(0, len(images), w['batch_size']))
+    results = evaluate(net, batches, w['model'], w['decoder_dist'], w['device'], w['preprocess'])
+    results['iter'] = iteration
+
+    # same latents for every checkpoint so the grids are comparable
+    generator = torch.Generator().manual_seed(w['seed'])
+    z = torch.randn(w['num_samples'], z_dim, generator=generator).to(w['device'])
+    with torch.no_grad():
+        samples = torch.sigmoid(net._decode(z)).cpu()
+    sample_path = os.path.join(w['output_dir'], 'samples_{}.png'.format(iteration))
+    save_image(samples.view(-1, w['nc'], w['input_size'], w['input_size']), sample_path,
+               nrow=int(w['num_samples']**0.5), pad_value=1)
+    results['samples'] = sample_path
+    return results
+
+
+def sweep_checkpoints(checkpoints, images, spec, num_procs):
+    """Evaluate `checkpoints` in a pool of `num_procs` processes.
+
+    `images` is the uint8 evaluation set. It is moved to shared memory once
+    and every worker reads the same pages. Each worker is pinned to its own
+    group of cores and runs torch with that many threads. `spec` describes
+    the model (net_cls, z_dim, nc, input_size, model, decoder_dist,
+    bit_packed, device) and the outputs (batch_size, num_samples, seed,
+    output_dir). Results are yielded in checkpoint order.
+    """
+    images.share_memory_()
+    core_groups = partition_cores(num_procs)
+    ctx = mp.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    with ctx.Pool(len(core_groups), initializer=_init_worker,
+                  initargs=(images, spec, core_groups, counter)) as pool:
+        for results in pool.imap(_evaluate_checkpoint, checkpoints):
+            yield results
+
+
+def write_table(rows, path):
+    """One row per checkpoint; per-dimension KL gets a column per latent."""
+    columns = ['iter', 'n', 'recon_loss', 'total_kld', 'mean_kld', 'elbo', 'w2_dist']
+    columns = [c for c in columns if any(c in row for row in rows)]
+    num_dims = max((len(row.get('dim_wise_kld', [])) for row in rows), default=0)
+    header = columns + ['kld_z{}'.format(j) for j in range(num_dims)] + ['samples']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            kld = row.get('dim_wise_kld', [])
+            writer.writerow([row.get(c, '') for c in columns]
+                            + kld + [''] * (num_dims - len(kld)) + [row['samples']])
@@ -0,0 +1,157 @@
+"""tune.py"""
+
+import copy
+import os
+import time
+
+import torch
+import torch.optim as optim
+
+from dataset import benchmark_loader
+from losses import reconstruction_loss, kl_divergence, Wasserstein2_dist
+from utils import read_proc_status
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        # writing 5 to clear_refs resets the VmHWM high-water mark
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+
+def peak_memory_mb(device):
+    """Peak allocated device memory on CUDA, peak resident memory otherwise."""
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return read_proc_status('VmHWM')
+
+
+def available_memory_mb(device):
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory / 2**20
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 1024
+    return float('inf')
+
+
+def _synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_training_step(net, x, model, decoder_dist, steps=5, warmup=2):
+    """Seconds per optimizer step on batch `x` and the peak memory (MB).
+
+    Runs on a copy of `net` with a fresh Adam optimizer, so the model being
+    tuned for is left untouched.
+    """
+    net = copy.deepcopy(net).train()
+    optimizer = optim.Adam(net.parameters())
+    device = x.device
+
+    def step():
+        if model == 'WAE':
+            x_recon, z = net(x)
+            loss = reconstruction_loss(x, x_recon, decoder_dist) + Wasserstein2_dist(z)
+        else:
+            x_recon, mu, logvar = net(x)
+            loss = reconstruction_loss(x, x_recon, decoder_dist) + kl_divergence(mu, logvar)[0]
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    reset_peak_memory(device)
+    for _ in range(warmup):
+        step()
+    _synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    _synchronize(device)
+    elapsed = (time.perf_counter() - start) / steps
+    return elapsed, peak_memory_mb(device)
+
+
+def tune(net, sample_batch, make_loader, model, decoder_dist, device,
+         batch_sizes, worker_counts, thread_counts, loaders=('processes', 'threads'),
+         memory_limit_mb=None, loader_batches=20, log=print):
+    """Pick the batch size, loader and thread settings with the most samples/sec.
+
+    The training step is timed for every batch size and torch thread count
+    on `sample_batch(batch_size)`. Every loader kind and worker count is
+    timed through `make_loader(kind, num_workers, batch_size)`. A
+    configuration's throughput is the smaller of the two rates, since the
+    prefetcher overlaps loading with the step. On the CPU, loader workers
+    and torch threads must share the cores. Configurations whose peak
+    memory exceeds `memory_limit_mb` are rejected. Returns all measured
+    configurations and the best one.
+    """
+    if memory_limit_mb is None:
+        memory_limit_mb = 0.9 * available_memory_mb(device)
+    on_cpu = torch.device(device).type == 'cpu'
+    num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    default_threads = torch.get_num_threads()
+
+    steps = {}
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in sorted(batch_sizes):
+            try:
+                seconds, memory = time_training_step(net, sample_batch(batch_size), model, decoder_dist)
+            except RuntimeError as e:
+                if 'out of memory' not in str(e):
+                    raise
+                if torch.device(device).type == 'cuda':
+                    torch.cuda.empty_cache()
+                log('[tune] batch {} threads {}: out of memory'.format(batch_size, threads))
+                break
+            steps[batch_size, threads] = (batch_size / seconds, memory)
+            log('[tune] batch {} threads {}: {:.1f}ms/step {:.0f} samples/sec peak {:.0f}MB'.format(
+                batch_size, threads, seconds*1e3, batch_size / seconds, memory))
+            if memory > memory_limit_mb:
+                break
+    torch.set_num_threads(default_threads)
+
+    reference_batch = min(batch_sizes, key=lambda b: abs(b - 64))
+    loading = {}
+    base_rss = read_proc_status('VmRSS')
+    for kind in loaders:
+        for num_workers in worker_counts:
+            if kind == 'threads' and num_workers == 0:
+                continue
+            loader = make_loader(kind, num_workers, reference_batch)
+            stats = benchmark_loader(loader, loader_batches)
+            del loader
+            loading[kind, num_workers] = (stats['images_per_sec'], max(0., stats['rss_mb'] - base_rss))
+            log('[tune] {} loader x{}: {:.0f} images/sec +{:.0f}MB resident'.format(
+                kind, num_workers, stats['images_per_sec'], loading[kind, num_workers][1]))
+
+    configs = []
+    for (batch_size, threads), (step_rate, step_memory) in steps.items():
+        for (kind, num_workers), (load_rate, load_memory) in loading.items():
+            if on_cpu and threads + num_workers > num_cores:
+                continue
+            # on the CPU the step and the loader's extra memory share the host
+            memory = step_memory + load_memory if on_cpu else step_memory
+            configs.append({'batch_size':batch_size, 'num_threads':threads,
+                            'loader':kind, 'num_workers':num_workers,
+                            'samples_per_sec':min(step_rate, load_rate),
+                            'step_samples_per_sec':step_rate, 'load_samples_per_sec':load_rate,
+                            'memory_mb':memory, 'fits':memory <= memory_limit_mb})
+
+    candidates = [c for c in configs if c['fits']]
+    if not candidates:
+        return configs, None
+    # within 5% of the fastest (e.g. when loading is the bottleneck) the
+    # configuration using the fewest cores and the least memory wins
+    top = max(c['samples_per_sec'] for c in candidates)
+    near = [c for c in candidates if c['samples_per_sec'] >= 0.95 * top]
+    best = min(near, key=lambda c: (c['num_workers'] + c['num_threads'], c['memory_mb']))
+    return configs, best
@@ -1,8 +1,11 @@
 """utils.py"""
 
 import argparse
+import random
 import subprocess
+import time
 
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
@@ -23,6 +26,49 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def get_rng_states():
+    """States of the python, numpy, torch and CUDA generators."""
+    states = {'python':random.getstate(),
+              'numpy':np.random.get_state(),
+              'torch':torch.get_rng_state()}
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'].cpu())
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in states['cuda']])
+
+
+def time_call(fn, x, repeats=10):
+    """Median seconds of `fn(x)` over `repeats` calls, after a warm-up call.
+    Pending CUDA work is waited for around every timed call."""
+    fn(x)
+    timings = []
+    for _ in range(repeats):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        start = time.perf_counter()
+        fn(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def read_proc_status(field, pid='self'):
+    """A memory field of /proc/<pid>/status (VmRSS, VmHWM, ...) in MB, 0 if missing."""
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return 0.
+
+
 def where(cond, x, y):
     """Do same operation as np.where
 
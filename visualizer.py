@@ -0,0 +1,119 @@
+"""visualizer.py"""
+
+import copy
+import queue
+import threading
+import traceback
+
+import numpy as np
+import torch
+from torchvision.utils import make_grid
+
+
+class VizWorker(object):
+    """Render TensorBoard image summaries in a background thread.
+
+    The training loop hands over a detached snapshot of the weights with
+    `submit`. The worker loads it into its own copy of the network and builds
+    the reconstruction, random sample and latent traversal grids off the
+    training thread. When the worker falls behind, new snapshots are dropped
+    instead of blocking training. A snapshot that fails to render is
+    reported and skipped; the worker keeps consuming the queue.
+    """
+
+    def __init__(self, net, writer, test_batch, num_samples=36, traverse=True,
+                 limit=3, inter=2/3, max_pending=1, z=None):
+        self.net = copy.deepcopy(net).eval()
+        for p in self.net.parameters():
+            p.requires_grad_(False)
+        self.z_dim = self.net.z_dim
+        self.writer = writer
+        self.test_batch = test_batch[:8].detach()
+        device = self.test_batch.device
+        if z is None:
+            z = torch.from_numpy(np.random.RandomState(123).randn(num_samples, self.z_dim).astype(np.float32))
+        self.z = z.to(device)
+        num_samples = len(self.z)
+        self.nrow = int(np.ceil(np.sqrt(num_samples)))
+        self.traverse = traverse
+        self.interpolation = torch.arange(-limit, limit+0.1, inter, device=device)
+
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, global_iter, net):
+        """Queue a weight snapshot of `net`. Returns False if it was dropped."""
+        if self.queue.full():
+            self.dropped += 1
+            return False
+        with torch.no_grad():
+            snapshot = {k:v.detach().clone() for k, v in net.state_dict().items()}
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+        try:
+            self.queue.put_nowait((global_iter, snapshot, event))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self):
+        """Render whatever is still queued and stop the worker."""
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            global_iter, snapshot, event = job
+            try:
+                if self.stream is None:
+                    self.render(global_iter, snapshot)
+                else:
+                    with torch.cuda.stream(self.stream):
+                        self.stream.wait_event(event)
+                        self.render(global_iter, snapshot)
+            except Exception:
+                self.failed += 1
+                print('[{}] visualization failed'.format(global_iter))
+                traceback.print_exc()
+
+    @torch.no_grad()
+    def render(self, global_iter, snapshot):
+        self.net.load_state_dict(snapshot)
+
+        # decode the posterior mean: sampling here would draw from the
+        # training process's RNG and break exact resumption
+        z = self.net._encode(self.test_batch)[:, :self.z_dim]
+        x_recon = torch.sigmoid(self.net._decode(z).view(self.test_batch.size()))
+        images = torch.cat([self.test_batch, x_recon]).cpu()
+        self.writer.add_image('recons', make_grid(images, nrow=8), global_iter)
+
+        samples = torch.sigmoid(self.net.decoder(self.z)).cpu()
+        self.writer.add_image('rand_samples', make_grid(samples, nrow=self.nrow), global_iter)
+
+        if self.traverse:
+            self.writer.add_image('traverse', self.traverse_grid(self.test_batch[:1]), global_iter)
+
+    def traverse_grid(self, x):
+        """Decode every latent dimension of `x` swept over the interpolation range."""
+        n = len(self.interpolation)
+        z_ori = self.net.encoder(x)[:, :self.z_dim]
+        z = z_ori.expand(self.z_dim, n, self.z_dim).clone()
+        dims = torch.arange(self.z_dim, device=z.device)
+        z[dims, :, dims] = self.interpolation
+        samples = torch.sigmoid(self.net.decoder(z.view(-1, self.z_dim))).cpu()
+        return make_grid(samples, nrow=n)